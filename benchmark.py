@@ -0,0 +1,205 @@
+# Offline benchmark of the exporter, scrapes a local fake SmartZone (fakevsz.py) and reports the cost of each scrape
+import argparse
+import cProfile
+import json
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+from prometheus_client.core import CollectorRegistry
+from prometheus_client.exposition import generate_latest
+
+from smartzone_exporter import SmartZoneCollector, StaticCollector, ReplayAdapter, load_fixture
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# Start the fake controller in its own process, so its CPU and memory are not counted as the exporter's
+def start_fake(args, aps):
+    port = free_port()
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakevsz.py'),
+               '--port', str(port), '--aps', str(aps), '--zones', str(args.zones), '--wlans', str(args.wlans),
+               '--latency', str(args.latency), '--latency-per-record', str(args.latency_per_record),
+               '--max-limit', str(args.max_limit), '--clients', str(args.clients)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    # The first line is printed once the inventory is built and the server is listening
+    process.stdout.readline()
+    return process, 'http://127.0.0.1:{}'.format(port)
+
+
+def stats(url):
+    return requests.get(url + '/stats').json()
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Fake controller in a separate process, or a fixture replayed in this one
+class FakeTarget():
+
+    def __init__(self, args, aps):
+        self.process, self.url = start_fake(args, aps)
+        self.transport = None
+        # The fake controller names its SSIDs SSID-0, SSID-1, ...
+        self.wlan_details = ['SSID-{}'.format(w) for w in range(args.wlans)] if args.wlan_details else []
+
+    def requests(self):
+        return stats(self.url)
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class ReplayTarget():
+
+    def __init__(self, args):
+        fixture = load_fixture(args.replay)
+        self.url = fixture['target']
+        self.transport = ReplayAdapter(fixture, args.replay_latency)
+        # Details are only in the fixture if they were recorded
+        self.wlan_details = os.environ['WLAN_DETAILS'].split(',') if os.environ.get('WLAN_DETAILS') else []
+
+    def requests(self):
+        return {'replayed': self.transport.requests, 'missing': self.transport.misses}
+
+    def close(self):
+        pass
+
+
+def run(args, target, profile=None):
+    try:
+        collector = SmartZoneCollector(target.url, 'admin', 'admin', False, page_size=args.page_size, page_workers=args.page_workers,
+                                       concurrency=args.concurrency, stream=args.stream, wlan_details=target.wlan_details,
+                                       transport=target.transport, shard_zones=args.shard_zones, client_stats=args.clients > 0)
+        before = target.requests()
+        scrapes = []
+        renders = []
+        cpu = []
+        if profile:
+            profile.enable()
+        for i in range(args.scrapes):
+            cpu_start = time.process_time()
+            start = time.perf_counter()
+            metrics = list(collector.collect())
+            scrapes.append(time.perf_counter() - start)
+
+            # Render the exposition like a scrape of /metrics would
+            registry = CollectorRegistry(auto_describe=False)
+            registry.register(StaticCollector(metrics))
+            start = time.perf_counter()
+            size = len(generate_latest(registry))
+            renders.append(time.perf_counter() - start)
+            cpu.append(time.process_time() - cpu_start)
+        if profile:
+            profile.disable()
+        after = target.requests()
+        collector._session.logout()
+    finally:
+        target.close()
+
+    requests_made = {k: v - before.get(k, 0) for k, v in after.items() if v - before.get(k, 0)}
+    return {
+        'aps': len(collector._ap_table.rows),
+        'scrapes': args.scrapes,
+        'scrape_seconds_min': min(scrapes),
+        'scrape_seconds_median': statistics.median(scrapes),
+        'scrape_seconds_max': max(scrapes),
+        'render_seconds_median': statistics.median(renders),
+        'cpu_seconds_median': statistics.median(cpu),
+        'requests_per_scrape': sum(requests_made.values()) / args.scrapes,
+        'requests': requests_made,
+        'exposition_bytes': size,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+
+# Compare with a previous run, return the measurements that got worse than the tolerance allows
+def regressions(results, baseline, tolerance):
+    previous = {r['aps']: r for r in baseline['results']}
+    failed = []
+    for r in results:
+        b = previous.get(r['aps'])
+        if b is None:
+            continue
+        for key in ('scrape_seconds_median', 'cpu_seconds_median', 'requests_per_scrape', 'peak_rss_bytes'):
+            if r[key] > b[key] * (1 + tolerance):
+                failed.append('{} APs: {} {:.4g} > {:.4g}'.format(r['aps'], key, r[key], b[key]))
+    return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the SmartZone exporter against a local fake controller')
+    parser.add_argument('--aps', default='100,1000,10000', help='Comma separated AP counts to benchmark (default=100,1000,10000)')
+    parser.add_argument('--scrapes', type=int, default=5, help='Scrapes per AP count (default=5)')
+    parser.add_argument('--zones', type=int, default=20, help='Number of zones of the fake controller (default=20)')
+    parser.add_argument('--wlans', type=int, default=4, help='Number of WLANs per zone of the fake controller (default=4)')
+    parser.add_argument('--latency', type=float, default=0, help='Fixed response time of the fake controller in seconds (default=0)')
+    parser.add_argument('--latency-per-record', type=float, default=0, help='Response time per returned record in seconds (default=0)')
+    parser.add_argument('--max-limit', type=int, default=1000, help='Largest query page size of the fake controller (default=1000)')
+    parser.add_argument('--clients', type=int, default=0, help='Clients of the fake controller, collected with the client statistics when above 0 (default=0)')
+    parser.add_argument('--page-size', type=int, default=1000, help='Exporter query page size (default=1000)')
+    parser.add_argument('--page-workers', type=int, default=4, help='Exporter concurrent page requests (default=4)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Exporter concurrent requests of a crawl (default=8)')
+    parser.add_argument('--stream', action='store_true', help='Parse query responses incrementally')
+    parser.add_argument('--shard-zones', action='store_true', help='Split the AP and WLAN queries by zone')
+    parser.add_argument('--wlan-details', action='store_true', help='Also collect WLAN encryption and schedule details')
+    parser.add_argument('--replay', help='Scrape a fixture recorded with getdata.py --record instead of the fake controller')
+    parser.add_argument('--replay-latency', type=float, default=0, help='Scale of the recorded response times when replaying (default=0)')
+    parser.add_argument('--profile', help='Write cProfile statistics of the scrapes to this file')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Fail if the results are worse than this saved JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown compared to the baseline (default=0.2)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Smaller inventories first, the peak RSS only grows during the run
+    sizes = sorted(int(n) for n in args.aps.split(','))
+
+    print('{:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>9} {:>10}'.format(
+        'APs', 'scrape', 'max', 'render', 'cpu', 'requests', 'peak MB', 'bytes'))
+    # The fixture has a fixed inventory, it replaces the AP counts
+    if args.replay:
+        sizes = [None]
+    profile = cProfile.Profile() if args.profile else None
+    results = []
+    for aps in sizes:
+        target = ReplayTarget(args) if args.replay else FakeTarget(args, aps)
+        r = run(args, target, profile)
+        results.append(r)
+        print('{:>8} {:>9.3f}s {:>9.3f}s {:>9.3f}s {:>9.3f}s {:>10.1f} {:>9.1f} {:>10}'.format(
+            r['aps'], r['scrape_seconds_median'], r['scrape_seconds_max'], r['render_seconds_median'],
+            r['cpu_seconds_median'], r['requests_per_scrape'], r['peak_rss_bytes'] / 1048576, r['exposition_bytes']))
+        sys.stdout.flush()
+
+    if profile:
+        profile.dump_stats(args.profile)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'options': vars(args), 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failed = regressions(results, json.load(f), args.tolerance)
+        for line in failed:
+            print('REGRESSION: ' + line)
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
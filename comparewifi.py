@@ -3,72 +3,450 @@ import sys
 import os
 import urllib.parse
 import json
+import argparse
+import csv
+import hashlib
+import time
+import tempfile
+import re
+import fnmatch
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 apiVersion = 'v11_1'
 
-def get_service_ticket(target, user, password, insecure=False):
+# Sessão com um pool de conexões, reutilizada por todas as requisições do modo bulk
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def get_service_ticket(target, user, password, insecure=False, session=None):
     if not insecure:
         requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
-    session = requests.Session()
+    session = session or requests.Session()
     r = session.post(f'{target}/wsg/api/public/{apiVersion}/serviceTicket',
                      json={'username': user, 'password': password},
                      verify=insecure)
     r.raise_for_status()
     return r.json().get('serviceTicket')
 
-def get_data(target, path, service_ticket, insecure=False, payload=None):
+# O service ticket vale com os direitos da conta da API, é removido das mensagens de erro
+# que trazem a URL da requisição
+ticket_pattern = re.compile(r'(serviceTicket=)[^&\s\'"]+')
+
+def redact(error):
+    return ticket_pattern.sub(r'\1<redacted>', str(error))
+
+def get_data(target, path, service_ticket, insecure=False, payload=None, session=None):
+    session = session or requests
     headers = {'Content-Type': 'application/json;charset=UTF-8'}
     url = f'{target}/wsg/api/public/{apiVersion}/{path}?serviceTicket={service_ticket}'
     if payload:
-        r = requests.post(url, json=payload, headers=headers, verify=insecure)
+        r = session.post(url, json=payload, headers=headers, verify=insecure)
     else:
-        r = requests.get(url, headers=headers, verify=insecure)
+        r = session.get(url, headers=headers, verify=insecure)
     r.raise_for_status()
     return r.json()
 
-def compare_dicts(baseline, other, prefix=''):
-    diffs = []
-    ignored_keys = {
-        'id', 'zoneId', 'wlanId', 'createdTime', 'lastModifiedTime', 'schedule.id',
-        'firewallProfileId', 'portalServiceProfile.id', 'scheduler_config.id',
-        'scheduler_config.zoneId', 'schedule.name', 'portalServiceProfile.name',
-        'portal_config.id', 'portal_config.zoneId'
-    }
-
-    for key in baseline:
-        path = f"{prefix}.{key}" if prefix else key
-        if path in ignored_keys:
-            continue
-        if key not in other:
-            diffs.append(f"{path} - só existe no baseline")
-        elif isinstance(baseline[key], dict) and isinstance(other[key], dict):
-            diffs.extend(compare_dicts(baseline[key], other[key], path))
-        elif isinstance(baseline[key], list) and isinstance(other[key], list):
-            set1 = set(json.dumps(item, sort_keys=True) for item in baseline[key])
-            set2 = set(json.dumps(item, sort_keys=True) for item in other[key])
-            only_in_1 = set1 - set2
-            only_in_2 = set2 - set1
-            if only_in_1 or only_in_2:
+# Configuração de uma WLAN, com o agendamento e o portal hotspot quando existirem
+# get(path, version) busca um objeto da API, version identifica a versão da WLAN para o cache
+# Editar um agendamento ou portal não muda o lastModifiedTime da WLAN, então eles vão sem versão e são sempre buscados
+def get_wlan_config(get, zone_id, wlan_id, version=None):
+    config = get(f'rkszones/{zone_id}/wlans/{wlan_id}', version)
+    schedule = config.get("schedule") or {}
+    if "id" in schedule and schedule["id"] != None:
+        config['scheduler_config'] = get(f'rkszones/{zone_id}/wlanSchedulers/{schedule["id"]}')
+    if config.get("portalServiceProfile") != None:
+        config['portal_config'] = get(f'rkszones/{zone_id}/portals/hotspot/{config["portalServiceProfile"]["id"]}')
+    return config
+
+# Cache em disco das configurações, um arquivo JSON por objeto da API
+# Um objeto é reutilizado enquanto a versão (lastModifiedTime) informada pela listagem não muda,
+# e no máximo por max_age segundos (0 sem limite)
+class ConfigCache():
+
+    def __init__(self, directory, target, max_age=0):
+        self.directory = directory
+        self.target = target
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def file(self, path):
+        key = hashlib.sha1(f'{self.target}/{path}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, path, version):
+        entry = None
+        if version is not None:
+            try:
+                with open(self.file(path), encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                pass
+        if entry is None or entry['version'] != version or (self.max_age > 0 and time.time() - entry['fetched'] > self.max_age):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['data']
+
+    def put(self, path, version, data):
+        # Escreve em um arquivo temporário e troca, para nunca deixar uma entrada pela metade
+        # mkstemp dá a cada escrita o seu próprio arquivo, as threads do modo bulk e do monitor gravam ao mesmo tempo
+        file = self.file(path)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file), prefix=os.path.basename(file) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'path': path, 'version': version, 'fetched': time.time(), 'data': data}, f)
+            os.replace(tmp, file)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+# Caminhos ignorados por padrão na comparação, padrões do fnmatch sobre o caminho com pontos
+# Itens de listas aparecem como lista[], ex. *[].id ignora o id dos itens de qualquer lista
+default_ignore = (
+    'id', 'zoneId', 'wlanId', 'createdTime', 'lastModifiedTime', 'schedule.id',
+    'firewallProfileId', 'portalServiceProfile.id', 'scheduler_config.id',
+    'scheduler_config.zoneId', 'schedule.name', 'portalServiceProfile.name',
+    'portal_config.id', 'portal_config.zoneId'
+)
+
+# Caminhos ignorados só nas linhas de um tipo de objeto
+# O nome de uma zona é a identidade dela e sempre difere do nome da zona baseline,
+# já o nome de uma WLAN continua sendo comparado
+kind_ignore = {'zone': ('name',)}
+
+# Campos usados para casar os itens de listas de objetos, na ordem de preferência
+# O id não está aqui porque muda de uma zona para outra
+default_list_keys = ('name', 'ssid', 'mac', 'macAddress', 'vlanId', 'ip', 'key')
+
+# Diferença encontrada: kind é only_baseline, only_other, changed, list_only_baseline ou list_only_other
+Difference = namedtuple('Difference', ['path', 'kind', 'baseline', 'other'])
+
+def format_difference(d):
+    if d.kind == 'only_baseline':
+        return f"{d.path} - só existe no baseline"
+    if d.kind == 'only_other':
+        return f"{d.path} - só existe no comparado"
+    if d.kind == 'list_only_baseline':
+        return f"{d.path} - apenas no baseline: {d.baseline}"
+    if d.kind == 'list_only_other':
+        return f"{d.path} - apenas no comparado: {d.other}"
+    return f"{d.path} - '{d.baseline}' !== '{d.other}'"
+
+# Grupo de uma diferença: o primeiro nível do caminho, ex. encryption.method -> encryption
+def difference_group(d):
+    return re.split(r'[.\[]', d.path, 1)[0]
+
+# Comparação estrutural de configurações
+# Cada subárvore recebe um hash canônico (sem os caminhos ignorados, sem depender da ordem das listas),
+# calculado uma vez; subárvores com o mesmo hash são iguais e não são percorridas
+class ConfigDiff():
+
+    def __init__(self, ignore=default_ignore, list_keys=default_list_keys):
+        self.list_keys = tuple(list_keys)
+        self._ignore = re.compile('|'.join(fnmatch.translate(p) for p in ignore)) if ignore else None
+        self._ignored = {}
+        self._children = {}
+        self._digests = {}
+
+    def ignored(self, path):
+        if self._ignore is None:
+            return False
+        result = self._ignored.get(path)
+        if result is None:
+            result = self._ignored[path] = bool(self._ignore.match(path))
+        return result
+
+    # Caminho do filho e se ele é ignorado, calculados uma vez por caminho
+    def child(self, path, key):
+        result = self._children.get((path, key))
+        if result is None:
+            p = f"{path}.{key}" if path else key
+            result = self._children[(path, key)] = (p, self.ignored(p))
+        return result
+
+    def digest(self, value, path=''):
+        # Valores simples viram sua representação, estruturas viram um hash de 16 bytes
+        # Os valores simples de uma estrutura entram juntos em um único repr(), só as subestruturas são percorridas
+        if not isinstance(value, (dict, list)):
+            return b's' + repr(value).encode('utf-8')
+        key = (id(value), path)
+        result = self._digests.get(key)
+        if result is not None:
+            return result[0]
+        scalars = []
+        parts = []
+        if isinstance(value, dict):
+            for k in sorted(value):
+                p, ignored = self.child(path, k)
+                if ignored:
+                    continue
+                v = value[k]
+                if isinstance(v, (dict, list)):
+                    parts.append(repr(k).encode('utf-8') + self.digest(v, p))
+                else:
+                    scalars.append((k, v))
+            head = b'{'
+        else:
+            item_path = f"{path}[]"
+            for v in value:
+                if isinstance(v, (dict, list)):
+                    parts.append(self.digest(v, item_path))
+                else:
+                    scalars.append(repr(v))
+            # A ordem dos itens não importa
+            scalars.sort()
+            parts.sort()
+            head = b'['
+        parts.insert(0, head + repr(scalars).encode('utf-8'))
+        result = b'h' + hashlib.blake2b(b''.join(parts), digest_size=16).digest()
+        # O objeto fica junto do hash para que seu id não seja reutilizado enquanto o hash estiver guardado
+        self._digests[key] = (result, value)
+        return result
+
+    def diff(self, baseline, other, prefix=''):
+        return list(self.compare(baseline, other, prefix, prefix))
+
+    # Os hashes ficam guardados entre comparações, assim o baseline é percorrido uma vez só
+    def clear(self):
+        self._digests.clear()
+
+    # path é o caminho genérico (lista[]), usado nos padrões ignorados e nos hashes
+    # where é o caminho mostrado, com o item casado (lista[campo=valor])
+    def compare(self, baseline, other, path, where):
+        if isinstance(baseline, dict) and isinstance(other, dict):
+            if self.digest(baseline, path) == self.digest(other, path):
+                return
+            for key in baseline:
+                p, ignored = self.child(path, key)
+                if ignored:
+                    continue
+                w = f"{where}.{key}" if where else key
+                if key not in other:
+                    yield Difference(w, 'only_baseline', baseline[key], None)
+                else:
+                    yield from self.compare(baseline[key], other[key], p, w)
+            for key in other:
+                if key not in baseline and not self.child(path, key)[1]:
+                    yield Difference(f"{where}.{key}" if where else key, 'only_other', None, other[key])
+        elif isinstance(baseline, list) and isinstance(other, list):
+            if self.digest(baseline, path) == self.digest(other, path):
+                return
+            item_path = f"{path}[]"
+            key = self.list_key(baseline, other)
+            if key is not None:
+                yield from self.compare_keyed(baseline, other, item_path, where, key)
+            else:
+                # Listas sem chave são comparadas como conjuntos de itens
+                hashes1 = set(self.digest(v, item_path) for v in baseline)
+                hashes2 = set(self.digest(v, item_path) for v in other)
+                only_in_1 = [v for v in baseline if self.digest(v, item_path) not in hashes2]
+                only_in_2 = [v for v in other if self.digest(v, item_path) not in hashes1]
                 if only_in_1:
-                    diffs.append(f"{path} - apenas no baseline: {[json.loads(x) for x in only_in_1]}")
+                    yield Difference(where, 'list_only_baseline', only_in_1, None)
                 if only_in_2:
-                    diffs.append(f"{path} - apenas no comparado: {[json.loads(x) for x in only_in_2]}")
-        elif baseline[key] != other[key]:
-            diffs.append(f"{path} - '{baseline[key]}' !== '{other[key]}'")
+                    yield Difference(where, 'list_only_other', None, only_in_2)
+        elif baseline != other:
+            yield Difference(where, 'changed', baseline, other)
+
+    # Valor usado para casar itens, estruturas são casadas pelo hash
+    def match(self, value):
+        return self.digest(value) if isinstance(value, (dict, list)) else value
+
+    def list_key(self, baseline, other):
+        # Primeiro campo presente em todos os itens dos dois lados, com valores únicos em cada lado
+        items = baseline + other
+        if not all(isinstance(v, dict) for v in items):
+            return None
+        for key in self.list_keys:
+            if all(key in v for v in items):
+                values1 = set(self.match(v[key]) for v in baseline)
+                values2 = set(self.match(v[key]) for v in other)
+                if len(values1) == len(baseline) and len(values2) == len(other):
+                    return key
+        return None
+
+    def compare_keyed(self, baseline, other, item_path, where, key):
+        others = {self.match(v[key]): v for v in other}
+        seen = set()
+        for v in baseline:
+            k = self.match(v[key])
+            o = others.get(k)
+            if o is None:
+                yield Difference(f"{where}[{key}={v[key]}]", 'only_baseline', v, None)
+                continue
+            seen.add(k)
+            if self.digest(v, item_path) != self.digest(o, item_path):
+                yield from self.compare(v, o, item_path, f"{where}[{key}={v[key]}]")
+        for k, v in others.items():
+            if k not in seen:
+                yield Difference(f"{where}[{key}={v[key]}]", 'only_other', None, v)
+
+# Padrões ignorados, os padrões de COMPARE_IGNORE (separados por vírgula) somam-se aos padrões padrão
+def ignore_patterns(extra=()):
+    env = [p for p in os.environ.get('COMPARE_IGNORE', '').split(',') if p]
+    return default_ignore + tuple(env) + tuple(extra)
+
+def compare_dicts(baseline, other, prefix='', engine=None):
+    engine = engine or ConfigDiff(ignore_patterns())
+    return [format_difference(d) for d in engine.diff(baseline, other, prefix)]
+
+# Um motor de comparação por tipo de linha, com os caminhos ignorados daquele tipo
+def drift_engines(ignore, list_keys=default_list_keys):
+    return {kind: ConfigDiff(tuple(ignore) + kind_ignore.get(kind, ()), list_keys) for kind in ('zone', 'wlan')}
+
+# Linha da matriz de drift de um objeto comparado com o baseline
+# O motor vem de drift_engines(), o do tipo da linha
+# status: ok, drift, missing (só no baseline), extra (só no comparado) ou error (um dos lados não pôde ser buscado)
+def drift_row(engine, kind, zone, ssid, baseline, config, error=None):
+    row = {'type': kind, 'zone': zone, 'ssid': ssid, 'status': 'ok', 'diffs': 0, 'groups': {}, 'details': []}
+    if error is not None:
+        row['status'] = 'error'
+    elif config is None:
+        row['status'] = 'missing'
+    elif baseline is None:
+        row['status'] = 'extra'
+    else:
+        differences = engine.diff(baseline, config)
+        for d in differences:
+            group = difference_group(d)
+            row['groups'][group] = row['groups'].get(group, 0) + 1
+        row['details'] = [format_difference(d) for d in differences]
+        row['diffs'] = len(differences)
+        if row['diffs']:
+            row['status'] = 'drift'
+    return row
+
+def write_matrix(matrix, output, fmt):
+    if fmt == 'json':
+        json.dump(matrix, output, indent=2, ensure_ascii=False)
+        output.write('\n')
+        return
+    # Uma coluna por grupo de configuração, com o número de diferenças no grupo
+    groups = sorted(set(g for row in matrix['rows'] for g in row['groups']))
+    writer = csv.writer(output)
+    writer.writerow(['type', 'zone', 'ssid', 'status', 'diffs'] + groups)
+    for row in matrix['rows']:
+        writer.writerow([row['type'], row['zone'], row['ssid'], row['status'], row['diffs']] + [row['groups'].get(g, 0) for g in groups])
+
+# fn que devolve (resultado, None), ou (None, exceção) quando falha,
+# para que um objeto com erro não derrube a busca de todos os outros
+def isolated(fn):
+    def call(item):
+        try:
+            return fn(item), None
+        except Exception as e:
+            return None, e
+    return call
 
-    for key in other:
-        path = f"{prefix}.{key}" if prefix else key
-        if path in ignored_keys:
+# Compara todas as zonas e WLANs com a zona baseline, buscando as configurações em paralelo
+# Uma zona ou WLAN que não pôde ser buscada vira uma linha com status error, só uma falha do baseline interrompe
+def bulk(target, user, password, insecure, args):
+    session = make_session(args.workers)
+    service_ticket = get_service_ticket(target, user, password, insecure, session)
+    cache = None if args.no_cache else ConfigCache(args.cache_dir, target, args.cache_max_age)
+
+    def get(path, version=None):
+        data = cache.get(path, version) if cache else None
+        if data is None:
+            data = get_data(target, path, service_ticket, insecure, session=session)
+            if cache:
+                cache.put(path, version if version is not None else data.get('lastModifiedTime'), data)
+        return data
+
+    all_zones = get_data(target, 'system/inventory', service_ticket, insecure, session=session)['list']
+    baseline_zone = next((z for z in all_zones if z['zoneName'] == args.baseline), None)
+    if not baseline_zone:
+        raise Exception(f"Zona '{args.baseline}' não encontrada.")
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        print(f"Buscando configuração de {len(all_zones)} zonas...", file=sys.stderr)
+        zone_configs = list(pool.map(isolated(lambda z: get(f'rkszones/{z["zoneId"]}', z.get('lastModifiedTime'))), all_zones))
+        zone_wlans = list(pool.map(isolated(lambda z: get_data(target, f'rkszones/{z["zoneId"]}/wlans', service_ticket, insecure, session=session)['list']), all_zones))
+
+        # Sem a zona baseline e as suas WLANs não há com o que comparar
+        baseline_index = all_zones.index(baseline_zone)
+        for result, error in (zone_configs[baseline_index], zone_wlans[baseline_index]):
+            if error is not None:
+                raise error
+
+        # Só as WLANs dos SSIDs pedidos, ou todas
+        wanted = [(z, w) for z, (wlans, error) in zip(all_zones, zone_wlans) if error is None
+                  for w in wlans if not args.ssid or w['ssid'] in args.ssid]
+        print(f"Buscando configuração de {len(wanted)} WLANs...", file=sys.stderr)
+        wlan_configs = list(pool.map(isolated(lambda zw: get_wlan_config(get, zw[0]['zoneId'], zw[1]['id'], zw[1].get('lastModifiedTime'))), wanted))
+
+    # Erros por (zona, SSID), com SSID vazio para a listagem de WLANs da zona
+    configs = {}
+    errors = {}
+    for z, (wlans, error) in zip(all_zones, zone_wlans):
+        if error is not None:
+            errors[(z['zoneId'], '')] = error
+            print(f"Falha ao listar as WLANs da zona '{z['zoneName']}': {redact(error)}", file=sys.stderr)
+    for (z, w), (config, error) in zip(wanted, wlan_configs):
+        if error is not None:
+            errors[(z['zoneId'], w['ssid'])] = error
+            print(f"Falha ao buscar a WLAN '{w['ssid']}' da zona '{z['zoneName']}': {redact(error)}", file=sys.stderr)
+        configs[(z['zoneId'], w['ssid'])] = config
+    baseline_config = zone_configs[baseline_index][0]
+    baseline_ssids = sorted(ssid for zone_id, ssid in configs if zone_id == baseline_zone['zoneId'])
+    if args.ssid:
+        baseline_ssids = sorted(set(baseline_ssids) | set(args.ssid))
+
+    engines = drift_engines(ignore_patterns(args.ignore), args.list_key or default_list_keys)
+    rows = []
+    for z, (config, error) in zip(all_zones, zone_configs):
+        if z is baseline_zone:
             continue
-        if key not in baseline:
-            diffs.append(f"{path} - só existe no comparado")
+        if error is not None:
+            print(f"Falha ao buscar a zona '{z['zoneName']}': {redact(error)}", file=sys.stderr)
+        rows.append(drift_row(engines['zone'], 'zone', z['zoneName'], '', baseline_config, config, error))
+        ssids = sorted(set(baseline_ssids) | set(ssid for zone_id, ssid in configs if zone_id == z['zoneId']))
+        for ssid in ssids:
+            error = errors.get((z['zoneId'], '')) or errors.get((z['zoneId'], ssid)) or errors.get((baseline_zone['zoneId'], ssid))
+            rows.append(drift_row(engines['wlan'], 'wlan', z['zoneName'], ssid, configs.get((baseline_zone['zoneId'], ssid)), configs.get((z['zoneId'], ssid)), error))
+
+    matrix = {'target': target, 'baseline': args.baseline, 'generated': int(time.time()), 'rows': rows}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8', newline='') as f:
+            write_matrix(matrix, f, args.format)
+    else:
+        write_matrix(matrix, sys.stdout, args.format)
 
-    return diffs
+    drift = sum(1 for r in rows if r['status'] not in ('ok', 'error'))
+    failed = sum(1 for r in rows if r['status'] == 'error')
+    print(f"{len(rows)} objetos comparados com '{args.baseline}', {drift} com diferenças, {failed} com erro.", file=sys.stderr)
+    if cache:
+        print(f"Cache: {cache.hits} reaproveitados, {cache.misses} buscados.", file=sys.stderr)
+
+def parse_bulk_args(argv):
+    parser = argparse.ArgumentParser(prog='comparewifi.py --bulk', description='Compara todas as zonas e WLANs com uma zona baseline')
+    parser.add_argument('baseline', help='Zona baseline')
+    parser.add_argument('--ssid', action='append', default=[], help='Compara apenas este SSID, pode ser repetido')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv', help='Formato da matriz de drift (padrão csv)')
+    parser.add_argument('--output', help='Arquivo de saída (padrão: saída padrão)')
+    parser.add_argument('--workers', type=int, default=16, help='Requisições em paralelo (padrão 16)')
+    parser.add_argument('--cache-dir', default='.comparewifi_cache', help='Diretório do cache de configurações (padrão .comparewifi_cache)')
+    parser.add_argument('--cache-max-age', type=float, default=86400, help='Idade máxima em segundos de uma configuração do cache, 0 sem limite (padrão 86400)')
+    parser.add_argument('--no-cache', action='store_true', help='Não usa o cache de configurações')
+    parser.add_argument('--ignore', action='append', default=[], metavar='PADRAO', help='Caminho ignorado na comparação, padrão do fnmatch (ex. *.description), pode ser repetido')
+    parser.add_argument('--list-key', action='append', default=[], metavar='CAMPO', help=f'Campo que casa os itens de listas, pode ser repetido (padrão {",".join(default_list_keys)})')
+    return parser.parse_args(argv)
 
 def main():
-    if len(sys.argv) == 4 and sys.argv[1] == "-z":
+    if len(sys.argv) >= 3 and sys.argv[1] in ("-b", "--bulk"):
+        mode = "bulk"
+        args = parse_bulk_args(sys.argv[2:])
+    elif len(sys.argv) == 4 and sys.argv[1] == "-z":
         mode = "zone"
         zones = [sys.argv[2], sys.argv[3]]
     elif len(sys.argv) == 5:
@@ -78,6 +456,7 @@ def main():
     else:
         print("Uso: wificompare.py <zone1> <ssid1> <zona2> <ssid2>")
         print("Ou:  wificompare.py -z <zone1> <zona2>")
+        print("Ou:  wificompare.py --bulk <zona_baseline> [--ssid <ssid>] [--format csv|json] [--output <arquivo>]")
         sys.exit(1)
 
     user = os.environ['API_USER']
@@ -90,7 +469,12 @@ def main():
         sys.exit(1)
 
     try:
+        if mode == "bulk":
+            bulk(target, user, password, insecure, args)
+            return
+
         service_ticket = get_service_ticket(target, user, password, insecure)
+        get = lambda path, version=None: get_data(target, path, service_ticket, insecure)
 
         all_zones = get_data(target, 'system/inventory', service_ticket, insecure)['list']
         zones_id = []
@@ -115,17 +499,9 @@ def main():
             baseline = f'{zones[0]}/{ssids[0]}'
             diff = f'{zones[1]}/{ssids[1]}'
             print(f"Buscando configuração de '{baseline}'...")
-            config1 = get_data(target, f'rkszones/{zones_id[0]}/wlans/{wlans_id[0]}', service_ticket, insecure)
-            if "id" in config1["schedule"] and config1["schedule"]["id"] != None:
-                config1['scheduler_config'] = get_data(target, f'rkszones/{zones_id[0]}/wlanSchedulers/{config1["schedule"]["id"]}', service_ticket, insecure)
-            if config1["portalServiceProfile"] != None:
-                config1['portal_config'] = get_data(target, f'rkszones/{zones_id[0]}/portals/hotspot/{config1["portalServiceProfile"]["id"]}', service_ticket, insecure)
+            config1 = get_wlan_config(get, zones_id[0], wlans_id[0])
             print(f"Buscando configuração de '{diff}'...")
-            config2 = get_data(target, f'rkszones/{zones_id[1]}/wlans/{wlans_id[1]}', service_ticket, insecure)
-            if "id" in config2["schedule"] and config2["schedule"]["id"] != None:
-                config2['scheduler_config'] = get_data(target, f'rkszones/{zones_id[1]}/wlanSchedulers/{config2["schedule"]["id"]}', service_ticket, insecure)
-            if config2["portalServiceProfile"] != None:
-                config2['portal_config'] = get_data(target, f'rkszones/{zones_id[1]}/portals/hotspot/{config2["portalServiceProfile"]["id"]}', service_ticket, insecure)
+            config2 = get_wlan_config(get, zones_id[1], wlans_id[1])
         else:
             baseline = f'{zones[0]}'
             diff = f'{zones[1]}'
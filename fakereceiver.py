@@ -0,0 +1,183 @@
+# Local stand-in for the receivers of the push mode, to test the exporter without Prometheus
+# Accepts remote write requests on /api/v1/write and Pushgateway pushes on /metrics/job/...,
+# keeps the latest sample of every series and reports what it received on /stats
+import argparse
+import gzip
+import json
+import math
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import remotewrite
+
+
+# Received series and counters shared by the request handlers
+class FakeReceiver():
+
+    def __init__(self, latency=0, error_rate=0, reject_rate=0):
+        # Simulated response time of every push
+        self.latency = latency
+        # Share of pushes answered with 503, to be retried, and with 400, to be dropped
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.random = random.Random()
+        # Series labels -> (value, timestamp) of the latest sample
+        self.series = {}
+        # Pushgateway grouping path -> number of samples of the last push
+        self.groups = {}
+        self.stats = {'requests': 0, 'samples': 0, 'stale': 0, 'bytes': 0, 'uncompressed_bytes': 0,
+                      'serverError': 0, 'rejected': 0, 'outOfOrder': 0, 'pushgateway': 0}
+        self.lock = threading.Lock()
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    # Stores the samples like Prometheus: a sample not newer than the last one of its series is refused
+    def write(self, timeseries):
+        with self.lock:
+            for labels, samples in timeseries:
+                key = tuple(sorted(labels.items()))
+                for value, timestamp in samples:
+                    last = self.series.get(key)
+                    if last is not None and timestamp <= last[1]:
+                        self.stats['outOfOrder'] += 1
+                        continue
+                    if remotewrite.is_stale(value):
+                        self.stats['stale'] += 1
+                        self.series.pop(key, None)
+                    else:
+                        self.series[key] = (value, timestamp)
+                    self.stats['samples'] += 1
+
+    def summary(self):
+        with self.lock:
+            return dict(self.stats, series=len(self.series), groups=self.groups.copy())
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj, code=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, text, code):
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        receiver = self.server.receiver
+        url = urllib.parse.urlparse(self.path)
+        # Always read the body, so a rejected request does not break the keep-alive connection
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        if url.path == '/stats':
+            return self.send_json(receiver.summary())
+        if url.path == '/series':
+            # Latest samples, optionally of one metric name
+            name = urllib.parse.parse_qs(url.query).get('name', [None])[0]
+            with receiver.lock:
+                series = [{'labels': dict(k), 'value': v if math.isfinite(v) else str(v), 'timestamp': t}
+                          for k, (v, t) in receiver.series.items() if name is None or dict(k).get('__name__') == name]
+            return self.send_json(series)
+
+        is_write = url.path == '/api/v1/write' and method == 'POST'
+        is_push = url.path.startswith('/metrics/job/') and method in ('PUT', 'POST')
+        if not is_write and not is_push:
+            return self.send_text('Not found\n', 404)
+
+        receiver.count('requests')
+        receiver.count('bytes', len(body))
+        if receiver.latency > 0:
+            time.sleep(receiver.latency)
+        draw = receiver.random.random()
+        if draw < receiver.error_rate:
+            receiver.count('serverError')
+            return self.send_text('Service unavailable\n', 503)
+        if draw < receiver.error_rate + receiver.reject_rate:
+            receiver.count('rejected')
+            return self.send_text('Rejected\n', 400)
+
+        try:
+            if is_write:
+                if self.headers.get('Content-Encoding') != 'snappy':
+                    raise ValueError('remote write bodies must be snappy compressed')
+                data = remotewrite.decompress(body)
+                receiver.count('uncompressed_bytes', len(data))
+                receiver.write(remotewrite.decode_write_request(data))
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            receiver.count('uncompressed_bytes', len(body))
+            samples = sum(1 for line in body.decode('utf-8').splitlines() if line and not line.startswith('#'))
+            receiver.count('pushgateway')
+            receiver.count('samples', samples)
+            with receiver.lock:
+                receiver.groups[url.path[len('/metrics/'):]] = samples
+            return self.send_json({})
+        except Exception as e:
+            receiver.count('rejected')
+            return self.send_text('{}\n'.format(e), 400)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+
+def make_server(port, receiver, address='127.0.0.1'):
+    server = ThreadingHTTPServer((address, port), FakeHandler)
+    server.daemon_threads = True
+    server.receiver = receiver
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Fake remote write receiver and Pushgateway for exporter tests')
+    parser.add_argument('--port', type=int, default=9201, help='Port to listen on (default=9201)')
+    parser.add_argument('--address', default='127.0.0.1', help='Address to listen on (default=127.0.0.1)')
+    parser.add_argument('--latency', type=float, default=0, help='Response time of each push in seconds (default=0)')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of pushes answered with 503 (default=0)')
+    parser.add_argument('--reject-rate', type=float, default=0, help='Share of pushes answered with 400 (default=0)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    receiver = FakeReceiver(args.latency, args.error_rate, args.reject_rate)
+    server = make_server(args.port, receiver, args.address)
+    print('Fake push receiver listening on http://{}:{}'.format(args.address, args.port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
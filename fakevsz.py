@@ -0,0 +1,347 @@
+# Local stand-in for the SmartZone public API, used to measure the exporter without a controller
+# Synthesizes an inventory of zones, APs and WLANs and answers the endpoints used by the exporter
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+apiVersion = 'v11_1'
+
+# Path segments followed by an object id, counted together in /stats
+id_collections = {'rkszones', 'wlans', 'wlanSchedulers', 'hotspot'}
+
+# Extra fields returned for each AP, the exporter ignores them but they make responses as large as the real ones
+ap_padding = ['description', 'location', 'administrativeState', 'registrationState', 'configState', 'meshRole',
+              'ipAddress', 'externalIp', 'firmwareVersion', 'serial', 'lastSeen', 'uptime', 'eth0Status',
+              'eth1Status', 'channel24G', 'channel50G', 'channel6G', 'txPower24G', 'txPower50G', 'airtime24G',
+              'airtime50G', 'noise24G', 'noise50G', 'rx', 'tx', 'txRx', 'meshHop', 'poePortStatus']
+
+
+# Extra fields returned for each client
+client_padding = ['ipAddress', 'ipv6Address', 'osType', 'hostName', 'userName', 'vlan', 'channel', 'radioType',
+                  'authMethod', 'encryptionMethod', 'bssid', 'txBytes', 'rxBytes', 'status', 'sessionStartTime']
+
+# Common PHY rates in bits per second
+client_rates = [6500000, 24000000, 54000000, 72200000, 144400000, 300000000, 433300000, 866700000, 1201000000, 2402000000]
+
+
+# Synthetic controller inventory
+class Inventory():
+
+    def __init__(self, aps, zones, wlans, seed=0, clients=0):
+        rnd = random.Random(seed)
+        self.seed = seed
+        self.clients = clients
+        self.wlans_per_zone = wlans
+        self.zones = [{'id': str(uuid.UUID(int=rnd.getrandbits(128))), 'name': 'Zone-{:03d}'.format(z)} for z in range(zones)]
+
+        # Spread the APs unevenly, a few zones hold most of them as on real controllers
+        weights = [1 / (z + 1) for z in range(zones)]
+        self.aps = []
+        for i in range(aps):
+            zone = rnd.choices(self.zones, weights)[0]
+            ap = {
+                'apMac': '{:02X}:{:02X}:{:02X}:{:02X}:{:02X}:{:02X}'.format(0x2C, 0xE6, 0xCC, (i >> 16) & 255, (i >> 8) & 255, i & 255),
+                'deviceName': 'AP-{:05d}'.format(i),
+                'zoneId': zone['id'],
+                'zoneName': zone['name'],
+                'apGroupName': 'Group-{}'.format(rnd.randint(0, 4)),
+                'status': rnd.choices(['Online', 'Offline', 'Flagged'], [90, 8, 2])[0],
+                'model': rnd.choice(['R550', 'R650', 'R750', 'R850', 'T350']),
+                'deviceGps': '{:.6f},{:.6f}'.format(rnd.uniform(-30, -20), rnd.uniform(-50, -40)) if rnd.random() < 0.7 else '',
+                'alerts': rnd.randint(0, 3),
+                'latency24G': rnd.randint(1, 50),
+                'latency50G': rnd.randint(1, 50),
+                'latency6G': rnd.choice([None, rnd.randint(1, 50)]),
+                'numClients24G': rnd.randint(0, 30),
+                'numClients5G': rnd.randint(0, 60),
+                'numClients6G': rnd.randint(0, 10),
+            }
+            for f in ap_padding:
+                ap[f] = 'x' * rnd.randint(4, 24)
+            self.aps.append(ap)
+
+        self.wlans = []
+        self.wlan_details = {}
+        self.schedulers = {}
+        self.portals = {}
+        for zone in self.zones:
+            for w in range(wlans):
+                wlan_id = str(w + 1)
+                wlan = {
+                    'zoneId': zone['id'],
+                    'zoneName': zone['name'],
+                    'wlanId': wlan_id,
+                    'name': 'WLAN-{}'.format(w),
+                    'ssid': 'SSID-{}'.format(w),
+                    'alerts': rnd.randint(0, 2),
+                    'clients': rnd.randint(0, 200),
+                }
+                self.wlans.append(wlan)
+                scheduler_id = str(uuid.UUID(int=rnd.getrandbits(128)))
+                portal_id = str(uuid.UUID(int=rnd.getrandbits(128)))
+                schedule_type = rnd.choice(['AlwaysOn', 'AlwaysOff', 'Customized'])
+                self.wlan_details[(zone['id'], wlan_id)] = {
+                    'id': wlan_id,
+                    'zoneId': zone['id'],
+                    'name': wlan['name'],
+                    'ssid': wlan['ssid'],
+                    'encryption': {'method': rnd.choice(['WPA2', 'None']), 'passphrase': 'pass {}'.format(w)},
+                    'schedule': {'type': schedule_type, 'id': scheduler_id if schedule_type == 'Customized' else None, 'name': 'Schedule-{}'.format(w)},
+                    'portalServiceProfile': {'id': portal_id, 'name': 'Portal-{}'.format(w)} if w % 2 else None,
+                    'vlan': {'accessVlan': 10 + w},
+                    'lastModifiedTime': 1700000000000,
+                }
+                self.portals[(zone['id'], portal_id)] = {
+                    'id': portal_id,
+                    'zoneId': zone['id'],
+                    'name': 'Portal-{}'.format(w),
+                    'portalUrl': 'https://portal.example.com/{}'.format(rnd.choice(['login', 'guest'])),
+                    'sessionTimeout': rnd.choice([1440, 1440, 720]),
+                    'walledGarden': ['*.example.com', 'portal.example.com'],
+                    'lastModifiedTime': 1700000000000,
+                }
+                self.schedulers[(zone['id'], scheduler_id)] = {
+                    'id': scheduler_id,
+                    'zoneId': zone['id'],
+                    'name': 'Schedule-{}'.format(w),
+                    'sun': [], 'mon': ['08:00-18:00'], 'tue': ['08:00-18:00'], 'wed': ['08:00-18:00'],
+                    'thu': ['08:00-18:00'], 'fri': ['08:00-18:00'], 'sat': [],
+                }
+
+    # Clients are synthesized page by page from their index, so large client counts take no memory
+    def client(self, i):
+        rnd = random.Random(self.seed * 1000003 + i)
+        ap = self.aps[rnd.randrange(len(self.aps))]
+        rssi = max(-95, min(-25, int(rnd.gauss(-65, 10))))
+        client = {
+            'clientMac': '{:02X}:{:02X}:{:02X}:{:02X}:{:02X}:{:02X}'.format(0x3C, 0x22, 0xFB, (i >> 16) & 255, (i >> 8) & 255, i & 255),
+            'apMac': ap['apMac'],
+            'apName': ap['deviceName'],
+            'ssid': 'SSID-{}'.format(rnd.randrange(self.wlans_per_zone)) if self.wlans_per_zone else '',
+            'rssi': rssi,
+            'snr': rssi + 95 + rnd.randint(-3, 3),
+            'txRatebps': rnd.choice(client_rates),
+        }
+        for f in client_padding:
+            client[f] = 'x' * rnd.randint(4, 16)
+        return client
+
+    def inventory(self):
+        result = []
+        for zone in self.zones:
+            aps = [a for a in self.aps if a['zoneId'] == zone['id']]
+            result.append({
+                'zoneId': zone['id'],
+                'zoneName': zone['name'],
+                'totalAPs': len(aps),
+                'discoveryAPs': 0,
+                'connectedAPs': len([a for a in aps if a['status'] == 'Online']),
+                'disconnectedAPs': len([a for a in aps if a['status'] == 'Offline']),
+                'rebootingAPs': 0,
+                'clients': sum(a['numClients24G'] + a['numClients5G'] + a['numClients6G'] for a in aps),
+            })
+        return result
+
+
+# Fake controller state shared by the request handlers
+class FakeController():
+
+    def __init__(self, inventory, latency=0, latency_per_record=0, max_limit=1000, ticket_ttl=0, error_rate=0, fail=()):
+        self.inventory = inventory
+        # Simulated response time: a fixed part plus a part per returned record
+        self.latency = latency
+        self.latency_per_record = latency_per_record
+        # Largest page the controller accepts, like the real query API
+        self.max_limit = max_limit
+        # Tickets are rejected after this many seconds, 0 keeps them valid forever
+        self.ticket_ttl = ticket_ttl
+        # Share of data requests answered with 503, and endpoints that always answer 500
+        self.error_rate = error_rate
+        self.fail = set(fail)
+        self.random = random.Random()
+        self.tickets = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+        # Zone inventory is computed once, it does not change during a run
+        self.zone_inventory = inventory.inventory()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.stats[endpoint] = self.stats.get(endpoint, 0) + 1
+
+    def valid(self, ticket):
+        issued = self.tickets.get(ticket)
+        return issued is not None and (self.ticket_ttl <= 0 or time.time() - issued < self.ticket_ttl)
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj, code=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        return json.loads(body) if body else {}
+
+    def handle_request(self, method):
+        controller = self.server.controller
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        # Always read the body, so a rejected request does not break the keep-alive connection
+        payload = self.read_json() if method in ('POST', 'PUT') else {}
+
+        if url.path == '/stats':
+            return self.send_json(controller.stats)
+        if url.path == '/wsg/api/public/apiInfo':
+            controller.count('apiInfo')
+            return self.send_json({'apiSupportVersions': [apiVersion]})
+
+        prefix = '/wsg/api/public/{}/'.format(apiVersion)
+        if not url.path.startswith(prefix):
+            return self.send_json({'message': 'Not found'}, 404)
+        path = url.path[len(prefix):]
+        ticket = params.get('serviceTicket', [None])[0]
+
+        if path == 'serviceTicket':
+            controller.count('serviceTicket')
+            if method == 'DELETE':
+                controller.tickets.pop(ticket, None)
+                return self.send_json({})
+            ticket = 'ST-{}'.format(uuid.uuid4().hex)
+            controller.tickets[ticket] = time.time()
+            return self.send_json({'serviceTicket': ticket, 'controllerVersion': '6.1.1.0.959'})
+
+        if not controller.valid(ticket):
+            controller.count('unauthorized')
+            return self.send_json({'message': 'Invalid service ticket'}, 401)
+
+        parts = path.split('/')
+        endpoint = '/'.join('{id}' if i > 0 and parts[i - 1] in id_collections else p for i, p in enumerate(parts))
+        if endpoint in controller.fail:
+            controller.count('serverError')
+            return self.send_json({'message': 'Internal server error'}, 500)
+        if controller.random.random() < controller.error_rate:
+            controller.count('serverError')
+            return self.send_json({'message': 'Service unavailable'}, 503)
+        inventory = controller.inventory
+        records = 1
+        if path == 'controller':
+            result = {'list': [{'id': 'controller-1', 'model': 'vSZ-H', 'serialNumber': 'FAKE0001', 'uptimeInSec': 86400,
+                                'hostName': 'fakevsz', 'version': '6.1.1.0.959', 'apVersion': '6.1.1.0.1274'}]}
+        elif path == 'system/inventory':
+            result = {'list': controller.zone_inventory}
+            records = len(controller.zone_inventory)
+        elif path in ('query/ap', 'query/wlan') and method == 'POST':
+            items = inventory.aps if path == 'query/ap' else inventory.wlans
+            # Only the zone filter is supported
+            for f in payload.get('filters') or []:
+                if f.get('type') == 'ZONE':
+                    items = [i for i in items if i['zoneId'] == f.get('value')]
+            page = int(payload.get('page', 1))
+            limit = min(int(payload.get('limit', 100)), controller.max_limit)
+            start = (page - 1) * limit
+            chunk = items[start:start + limit]
+            result = {'totalCount': len(items), 'hasMore': start + limit < len(items), 'firstIndex': start, 'list': chunk}
+            records = len(chunk)
+        elif path == 'query/client' and method == 'POST':
+            page = int(payload.get('page', 1))
+            limit = min(int(payload.get('limit', 100)), controller.max_limit)
+            start = (page - 1) * limit
+            chunk = [inventory.client(i) for i in range(start, min(start + limit, inventory.clients))] if inventory.aps else []
+            result = {'totalCount': inventory.clients, 'hasMore': start + limit < inventory.clients, 'firstIndex': start, 'list': chunk}
+            records = len(chunk)
+        elif path == 'rkszones':
+            result = {'totalCount': len(inventory.zones), 'hasMore': False, 'list': inventory.zones}
+        elif len(parts) == 2 and parts[0] == 'rkszones':
+            zone = next((z for z in inventory.zones if z['id'] == parts[1]), None)
+            result = dict(zone, lastModifiedTime=1700000000000) if zone else None
+        elif len(parts) == 3 and parts[0] == 'rkszones' and parts[2] == 'wlans':
+            wlans = [{'id': w['wlanId'], 'name': w['name'], 'ssid': w['ssid'], 'zoneId': w['zoneId'],
+                      'lastModifiedTime': inventory.wlan_details[(w['zoneId'], w['wlanId'])]['lastModifiedTime']}
+                     for w in inventory.wlans if w['zoneId'] == parts[1]]
+            result = {'totalCount': len(wlans), 'hasMore': False, 'list': wlans}
+        elif len(parts) == 4 and parts[0] == 'rkszones' and parts[2] == 'wlans':
+            result = inventory.wlan_details.get((parts[1], parts[3]))
+        elif len(parts) == 4 and parts[0] == 'rkszones' and parts[2] == 'wlanSchedulers':
+            result = inventory.schedulers.get((parts[1], parts[3]))
+        elif len(parts) == 5 and parts[0] == 'rkszones' and parts[2:4] == ['portals', 'hotspot']:
+            result = inventory.portals.get((parts[1], parts[4]))
+        else:
+            result = None
+
+        if result is None:
+            controller.count('notFound')
+            return self.send_json({'message': 'Resource not found'}, 404)
+        controller.count(endpoint)
+        delay = controller.latency + controller.latency_per_record * records
+        if delay > 0:
+            time.sleep(delay)
+        return self.send_json(result)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+def make_server(port, controller, address='127.0.0.1'):
+    server = ThreadingHTTPServer((address, port), FakeHandler)
+    server.daemon_threads = True
+    server.controller = controller
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Fake SmartZone API for exporter benchmarks')
+    parser.add_argument('--port', type=int, default=8443, help='Port to listen on (default=8443)')
+    parser.add_argument('--address', default='127.0.0.1', help='Address to listen on (default=127.0.0.1)')
+    parser.add_argument('--aps', type=int, default=1000, help='Number of APs to synthesize (default=1000)')
+    parser.add_argument('--zones', type=int, default=20, help='Number of zones (default=20)')
+    parser.add_argument('--wlans', type=int, default=4, help='Number of WLANs per zone (default=4)')
+    parser.add_argument('--clients', type=int, default=0, help='Number of clients answered by query/client (default=0)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the inventory (default=0)')
+    parser.add_argument('--latency', type=float, default=0, help='Fixed response time of each request in seconds (default=0)')
+    parser.add_argument('--latency-per-record', type=float, default=0, help='Additional response time per returned record in seconds (default=0)')
+    parser.add_argument('--max-limit', type=int, default=1000, help='Largest query page size accepted (default=1000)')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of data requests answered with 503 (default=0)')
+    parser.add_argument('--fail', action='append', default=[], help='Endpoint always answered with 500, e.g. rkszones/{id}/wlanSchedulers/{id}')
+    parser.add_argument('--ticket-ttl', type=float, default=0, help='Seconds before a service ticket is rejected, 0 for never (default=0)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    inventory = Inventory(args.aps, args.zones, args.wlans, args.seed, args.clients)
+    controller = FakeController(inventory, args.latency, args.latency_per_record, args.max_limit, args.ticket_ttl, args.error_rate, args.fail)
+    server = make_server(args.port, controller, args.address)
+    print('Fake SmartZone with {} APs listening on http://{}:{}'.format(args.aps, args.address, args.port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
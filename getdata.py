@@ -4,6 +4,7 @@ import os
 import urllib.parse
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 import json
+from smartzone_exporter import SmartZoneCollector, RecordingAdapter
 
 # API version compatível
 apiVersion = 'v11_1'
@@ -29,13 +30,29 @@ def get_data(target, path, service_ticket, insecure=False, payload=None):
     r.raise_for_status()
     return r.json()
 
+# Grava todas as requisições e respostas de uma coleta do exporter em um arquivo de fixture
+def record(target, user, password, insecure, fixture):
+    wlan_details = os.environ['WLAN_DETAILS'].split(',') if os.environ.get('WLAN_DETAILS') else []
+    adapter = RecordingAdapter(pool_connections=1, pool_maxsize=16)
+    collector = SmartZoneCollector(target, user, password, insecure, wlan_details=wlan_details, transport=adapter)
+    # A coleta que falhou também é gravada, para reproduzir o erro
+    try:
+        list(collector.collect())
+    finally:
+        collector._session.logout()
+        adapter.save(fixture, target)
+    return len(adapter.exchanges)
+
 def main():
-    if len(sys.argv) != 2:
-        print("Uso: getdata.py <path>")
+    if len(sys.argv) == 3 and sys.argv[1] == '--record':
+        path = None
+        fixture = sys.argv[2]
+    elif len(sys.argv) == 2:
+        path = sys.argv[1]
+    else:
+        print("Uso: getdata.py <path> | getdata.py --record <fixture.json.gz>")
         sys.exit(1)
 
-    path = sys.argv[1]
-
     user = os.environ['API_USER']
     password = os.environ['API_PASSWORD']
     target = os.environ['VSZ_TARGET']
@@ -46,6 +63,15 @@ def main():
         print("Defina as variáveis de ambiente VSZ_TARGET, API_USER e API_PASSWORD.")
         sys.exit(1)
 
+    if path is None:
+        try:
+            count = record(target, user, password, insecure, fixture)
+            print(f"{count} requisições gravadas em {fixture}")
+        except Exception as e:
+            print(f"Erro ao gravar fixture: {e}")
+            sys.exit(1)
+        return
+
     try:
         service_ticket = get_service_ticket(target, user, password, insecure)
 
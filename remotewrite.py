@@ -0,0 +1,237 @@
+# Prometheus remote write 1.0 payloads, shared by the exporter and the fake receiver (fakereceiver.py)
+# The WriteRequest protobuf messages are encoded by hand and compressed with the snappy block format,
+# so pushing needs no dependency beyond the exporter's own; python-snappy is used when it is installed
+import struct
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+# Headers of every remote write request
+headers = {
+    'Content-Encoding': 'snappy',
+    'Content-Type': 'application/x-protobuf',
+    'X-Prometheus-Remote-Write-Version': '0.1.0',
+}
+
+# NaN with the bit pattern Prometheus uses as staleness marker, it ends a series at once
+stale_nan = struct.unpack('<d', struct.pack('<Q', 0x7ff0000000000002))[0]
+
+def is_stale(value):
+    return struct.pack('<d', value) == struct.pack('<Q', 0x7ff0000000000002)
+
+_double = struct.Struct('<d')
+
+
+def varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+# message WriteRequest { repeated TimeSeries timeseries = 1; }
+# message TimeSeries { repeated Label labels = 1; repeated Sample samples = 2; }
+# message Label { string name = 1; string value = 2; }
+# message Sample { double value = 1; int64 timestamp = 2; }
+
+def _field(tag, payload):
+    return tag + varint(len(payload)) + payload
+
+# Labels of a series as the repeated Label fields of its TimeSeries
+# They are encoded once per series and reused for every sample; receivers require them sorted by name
+def encode_labels(labels):
+    out = []
+    for name, value in sorted(labels):
+        name = name.encode('utf-8')
+        value = value.encode('utf-8')
+        out.append(_field(b'\x0a', _field(b'\x0a', name) + _field(b'\x12', value)))
+    return b''.join(out)
+
+# TimeSeries with a single sample, timestamp in milliseconds
+def encode_series(labels, value, timestamp):
+    sample = b'\x09' + _double.pack(value) + b'\x10' + varint(timestamp)
+    return _field(b'\x0a', labels + _field(b'\x12', sample))
+
+# WriteRequest of series encoded with encode_series, which are already timeseries fields
+def encode_write_request(series):
+    return b''.join(series)
+
+
+def _fields(data):
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = read_varint(data, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = read_varint(data, pos)
+        elif wire == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire == 2:
+            length, pos = read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError('unsupported protobuf wire type {}'.format(wire))
+        yield key >> 3, value
+
+# Decoded WriteRequest as a list of (labels, samples), samples being (value, timestamp) pairs
+def decode_write_request(data):
+    result = []
+    for number, series in _fields(data):
+        if number != 1:
+            continue
+        labels = {}
+        samples = []
+        for field, value in _fields(series):
+            if field == 1:
+                label = dict(_fields(value))
+                labels[label.get(1, b'').decode('utf-8')] = label.get(2, b'').decode('utf-8')
+            elif field == 2:
+                sample = dict(_fields(value))
+                timestamp = sample.get(2, 0)
+                # int64 timestamps before 1970 are two's complement varints
+                if timestamp >= 1 << 63:
+                    timestamp -= 1 << 64
+                samples.append((_double.unpack(sample[1])[0] if 1 in sample else 0.0, timestamp))
+        result.append((labels, samples))
+    return result
+
+
+# Snappy block format: the uncompressed length as varint, then literals and back-references
+# The pure Python compressor looks up every 4-byte sequence in a dictionary and extends the matches,
+# the series of a request repeat the same label names and values, so most of the payload becomes copies
+
+def _literal(out, data, start, end):
+    while start < end:
+        n = min(end - start, 65536)
+        if n <= 60:
+            out.append((n - 1) << 2)
+        elif n <= 256:
+            out.append(60 << 2)
+            out.append(n - 1)
+        else:
+            out.append(61 << 2)
+            out += (n - 1).to_bytes(2, 'little')
+        out += data[start:start + n]
+        start += n
+
+def _copy(out, offset, length):
+    # Copies hold at most 64 bytes, and the short form at least 4
+    while length >= 68:
+        out.append((63 << 2) | 2)
+        out += offset.to_bytes(2, 'little')
+        length -= 64
+    if length > 64:
+        out.append((59 << 2) | 2)
+        out += offset.to_bytes(2, 'little')
+        length -= 60
+    if length < 12 and offset < 2048:
+        out.append(((offset >> 8) << 5) | ((length - 4) << 2) | 1)
+        out.append(offset & 0xff)
+    else:
+        out.append(((length - 1) << 2) | 2)
+        out += offset.to_bytes(2, 'little')
+
+def _compress(data):
+    data = bytes(data)
+    n = len(data)
+    out = bytearray(varint(n))
+    table = {}
+    literal = 0
+    i = 0
+    end = n - 4
+    while i <= end:
+        key = data[i:i + 4]
+        candidate = table.get(key)
+        table[key] = i
+        if candidate is None or i - candidate > 65535:
+            i += 1
+            continue
+        length = 4
+        limit = n - i
+        while length + 16 <= limit and data[candidate + length:candidate + length + 16] == data[i + length:i + length + 16]:
+            length += 16
+        while length < limit and data[candidate + length] == data[i + length]:
+            length += 1
+        _literal(out, data, literal, i)
+        _copy(out, i - candidate, length)
+        i += length
+        literal = i
+        # Index the end of the match, so the next sequence can start a copy right away
+        if i - 1 <= end:
+            table[data[i - 1:i + 3]] = i - 1
+    _literal(out, data, literal, n)
+    return bytes(out)
+
+def _decompress(data):
+    length, pos = read_varint(data, 0)
+    out = bytearray()
+    end = len(data)
+    while pos < end:
+        tag = data[pos]
+        pos += 1
+        kind = tag & 3
+        if kind == 0:
+            n = tag >> 2
+            if n >= 60:
+                size = n - 59
+                n = int.from_bytes(data[pos:pos + size], 'little')
+                pos += size
+            n += 1
+            out += data[pos:pos + n]
+            pos += n
+            continue
+        if kind == 1:
+            n = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        elif kind == 2:
+            n = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 2], 'little')
+            pos += 2
+        else:
+            n = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 4], 'little')
+            pos += 4
+        start = len(out) - offset
+        if offset == 0 or start < 0:
+            raise ValueError('invalid snappy copy offset {}'.format(offset))
+        if offset >= n:
+            out += out[start:start + n]
+        else:
+            # Overlapping copy, repeats the last offset bytes
+            for k in range(n):
+                out.append(out[start + k])
+    if len(out) != length:
+        raise ValueError('snappy length mismatch, {} bytes instead of {}'.format(len(out), length))
+    return bytes(out)
+
+def compress(data):
+    if snappy is not None:
+        return snappy.compress(data)
+    return _compress(data)
+
+def decompress(data):
+    if snappy is not None:
+        return snappy.decompress(data)
+    return _decompress(data)
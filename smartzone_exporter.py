@@ -7,91 +7,1246 @@ import urllib.parse
 # Allow for silencing insecure warnings from requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
+# Adapter used to size the connection pool of the persistent session
+# Transport adapters also record and replay API fixtures
+from requests.adapters import HTTPAdapter, BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
 # Builtin JSON module for testing - might not need later
 import json
 
 # Needed for sleep and exporter start/end time metrics
 import time
 
+# Jitter of the retry backoff
+import random
+
 # argparse module used for providing command-line interface
 import argparse
 
 # Prometheus modules for HTTP server & metrics
-from prometheus_client import start_http_server, Summary
-from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, InfoMetricFamily, REGISTRY
+from prometheus_client import make_wsgi_app, Summary, Histogram, Counter, Gauge, Info
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, InfoMetricFamily, GaugeHistogramMetricFamily, CollectorRegistry, REGISTRY
+from prometheus_client.exposition import ThreadingWSGIServer, choose_encoder, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.openmetrics.exposition import generate_latest as openmetrics_generate_latest
+from prometheus_client.samples import Sample
+from prometheus_client.utils import floatToGoString
+
+# Compression, checksum and HTTP dates of the pre-rendered exposition, also used by the API fixtures
+import gzip
+# State file kept between restarts
+import pickle
+import hashlib
+import tempfile
+import gc
+import zlib
+import io
+from email.utils import formatdate
+
+# WSGI server used to serve both /metrics and /probe
+from wsgiref.simple_server import make_server, WSGIRequestHandler
 
 import signal
+import threading
+
+# Ordered dictionary used as LRU storage for the configuration caches
+# Named tuples used as compact AP and client records, counters as client statistic bins
+import collections
+from collections import OrderedDict, namedtuple
+from operator import attrgetter, itemgetter
+
+# Shell-style patterns selecting zones and AP groups
+from fnmatch import fnmatchcase
+
+# Priority queue used to balance the zone shards
+import heapq
+
+# Incremental decoding of streamed responses
+import codecs
+
+# Typed arrays holding the AP metric values
+from array import array
+
+# Histogram buckets and quantile bins of the client statistics
+from bisect import bisect_left
+import math
+
+# Configuration comparison shared with comparewifi.py
+# Service tickets are removed by redact() from logged errors whose message includes the request URL
+from comparewifi import drift_engines, drift_row, get_wlan_config, ignore_patterns, isolated, redact
+
+# Remote write payloads of the push mode
+import remotewrite
+import base64
+
+# Worker pools and event loop used to run the crawl requests concurrently
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 
 # Compatible Ruckus API version
 apiVersion = 'v11_1'
 
-# Create SmartZoneCollector as a class - in Python3, classes inherit object as a base class
-# Only need to specify for compatibility or in Python2
+# Exporter self-metrics, to find which API endpoint or collection phase is slow
+api_request_duration = Histogram('smartzone_exporter_api_request_duration_seconds',
+    'Duration of SmartZone API requests',
+    ['target', 'endpoint', 'code'],
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, float('inf')))
+api_response_size = Summary('smartzone_exporter_api_response_size_bytes',
+    'Size of SmartZone API response bodies',
+    ['target', 'endpoint', 'code'])
+api_last_success = Gauge('smartzone_exporter_api_last_success_timestamp_seconds',
+    'Unix time of the last successful request to the API endpoint',
+    ['target', 'endpoint'])
+api_logins = Counter('smartzone_exporter_api_logins',
+    'Number of service ticket requests, by reason (initial, expired or rejected ticket)',
+    ['target', 'reason'])
+api_retries = Counter('smartzone_exporter_api_retries',
+    'Number of API requests retried after a connection error, timeout or server error',
+    ['target', 'endpoint'])
+api_circuit_open = Gauge('smartzone_exporter_api_circuit_open',
+    'Whether requests to the API endpoint are suspended after repeated failures',
+    ['target', 'endpoint'])
+collect_phase_duration = Gauge('smartzone_exporter_collect_phase_duration_seconds',
+    'Duration of each phase of the last crawl: login, fetch (network) and build_<group> (metric construction)',
+    ['target', 'phase'])
+push_requests = Counter('smartzone_exporter_push_requests',
+    'Push requests by result: success, retry, rejected by the receiver or failed after the last retry',
+    ['target', 'result'])
+push_samples = Counter('smartzone_exporter_push_samples',
+    'Samples delivered to the push receiver',
+    ['target'])
+push_bytes = Counter('smartzone_exporter_push_bytes',
+    'Compressed bytes delivered to the push receiver',
+    ['target'])
+push_dropped = Counter('smartzone_exporter_push_dropped_batches',
+    'Batches dropped because the push queue was full',
+    ['target'])
+push_queue = Gauge('smartzone_exporter_push_queue_batches',
+    'Batches waiting to be pushed',
+    ['target'])
+push_last_success = Gauge('smartzone_exporter_push_last_success_timestamp_seconds',
+    'Unix time of the last push accepted by the receiver',
+    ['target'])
+# The self-metrics are labeled with the configured target name, this maps it to the controller URL
+target_info = Info('smartzone_exporter_target',
+    'Controller URL of the configured target',
+    ['target'])
 
-class SmartZoneCollector():
+# Path segments followed by an object id, replaced by {id} to keep the endpoint label bounded
+id_collections = {'rkszones', 'wlans', 'wlanSchedulers', 'hotspot', 'apgroups', 'aps'}
 
-    # Initialize the class and specify required argument with no default value
-    # When defining class methods, must explicitly list `self` as first argument
-    def __init__(self, target, user, password, insecure):
-        # Strip any trailing "/" characters from the provided url
+def endpoint_name(api_path):
+    parts = api_path.split('/')
+    return '/'.join('{id}' if i > 0 and parts[i - 1] in id_collections else p for i, p in enumerate(parts))
+
+# Sessions currently logged in
+active_sessions = []
+
+# Set on SIGTERM, the main thread then saves the states and logs out
+# Requests failing from then on are interrupted by the exit, they are not reported
+stopping = threading.Event()
+
+# Server errors worth retrying, the controller is restarting or overloaded
+retry_status = {500, 502, 503, 504}
+
+# Raised instead of sending a request while the circuit of its endpoint is open
+class CircuitOpenError(requests.RequestException):
+    pass
+
+# Raised instead of logging in again once the session was closed on exit
+class SessionClosedError(requests.RequestException):
+    pass
+
+# Stops requests to an endpoint after `threshold` consecutive failures
+# After `reset` seconds one request is let through, and closes the circuit again if it succeeds
+class CircuitBreaker():
+
+    def __init__(self, threshold, reset):
+        self._threshold = threshold
+        self._reset = reset
+        self._failures = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self._threshold > 0 and self._failures >= self._threshold
+
+    def allow(self):
+        with self._lock:
+            if not self.open:
+                return True
+            if time.time() - self._opened >= self._reset:
+                # Half-open, the other requests wait for the outcome of this one
+                self._opened = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.open:
+                self._opened = time.time()
+
+# Long-lived API session shared by every crawl
+# Keeps a pool of keep-alive connections to the controller and caches the service ticket,
+# logging in again only when the ticket expires or the controller rejects it
+class SmartZoneSession():
+
+    def __init__(self, target, user, password, insecure, pool_size=16, ticket_ttl=1800, timeout=30, transport=None,
+                 retries=2, backoff=0.5, breaker_threshold=5, breaker_reset=60, name=None):
         self._target = target.rstrip("/")
-        # Take these arguments as provided, no changes needed
+        # Target label of the self-metrics, the configured name or else the URL
+        self._name = name or self._target
         self._user = user
         self._password = password
         self._insecure = insecure
+        self._ticket_ttl = ticket_ttl
+        # Applied to every request, so a hung controller cannot block a crawl forever
+        self._timeout = timeout
+        # Failed requests are retried with exponential backoff, and endpoints failing repeatedly are suspended
+        self._retries = retries
+        self._backoff = backoff
+        self._breaker_threshold = breaker_threshold
+        self._breaker_reset = breaker_reset
+        self._breakers = {}
 
-        self._compatible = False
-        self._headers = {'Content-Type': 'application/json;charset=UTF-8'}
-        self._service_ticket = ''
-
-        self._wlan_details = os.environ['WLAN_DETAILS'].split(',')
-
-        # With the exception of uptime, all of these metrics are strings
-        # Following the example of node_exporter, we'll set these string metrics with a default value of 1
-
-    def get_session(self):
         # Disable insecure request warnings if SSL verification is disabled
         if self._insecure == False:
              requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
         # Session object used to keep persistent cookies and connection pooling
-        s = requests.Session()
+        # A transport adapter replaces the HTTP connections, e.g. to record or replay a fixture
+        self._session = requests.Session()
+        adapter = transport or HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._session.headers.update({'Content-Type': 'application/json;charset=UTF-8'})
+        self._session.verify = self._insecure
 
+        self.compatible = False
+        self._service_ticket = None
+        self._ticket_time = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def url(self, api_path, service_ticket):
+        return '{}/wsg/api/public/{}/{}?serviceTicket={}'.format(self._target, apiVersion, api_path, service_ticket)
+
+    def login(self):
         # Verify version compatibility
-        r = s.get('{}/wsg/api/public/apiInfo'.format(self._target), verify=self._insecure)
+        r = self._session.get('{}/wsg/api/public/apiInfo'.format(self._target), timeout=self._timeout)
         supported_versions = r.json().get('apiSupportVersions')
-        self._compatible = any(apiVersion in x  for x in supported_versions)
+        self.compatible = any(apiVersion in x  for x in supported_versions)
 
         # Define URL arguments as a dictionary of strings 'payload'
         payload = {'username': self._user, 'password': self._password}
 
         # Call the payload using the json parameter
-        r = s.post('{}/wsg/api/public/{}/serviceTicket'.format(self._target, apiVersion), json=payload, verify=self._insecure)
+        r = self._session.post('{}/wsg/api/public/{}/serviceTicket'.format(self._target, apiVersion), json=payload, timeout=self._timeout)
 
         # Raise bad requests
         r.raise_for_status()
 
-        # Create a dictionary from the cookie name-value pair, then get the value based on the JSESSIONID key
         self._service_ticket = r.json().get('serviceTicket')
+        self._ticket_time = time.time()
+        if self not in active_sessions:
+            active_sessions.append(self)
+
+    def ticket(self):
+        # Only one thread logs in, the others wait and reuse the new ticket
+        with self._lock:
+            if self._closed:
+                raise SessionClosedError('Session of {} is closed'.format(self._target))
+            if self._service_ticket is None or time.time() - self._ticket_time > self._ticket_ttl:
+                if self._ticket_time == 0:
+                    reason = 'initial'
+                elif self._service_ticket is None:
+                    reason = 'rejected'
+                else:
+                    reason = 'expired'
+                api_logins.labels(self._name, reason).inc()
+                self.login()
+            return self._service_ticket
+
+    def invalidate(self, service_ticket):
+        # Drop the ticket unless another thread already replaced it
+        with self._lock:
+            if self._service_ticket == service_ticket:
+                self._service_ticket = None
+
+    def send(self, method, api_path, service_ticket, payload, stream):
+        # Time every request, labeled by endpoint and status code
+        endpoint = endpoint_name(api_path)
+        start = time.time()
+        try:
+            r = self._session.request(method, self.url(api_path, service_ticket), json=payload, timeout=self._timeout, stream=stream)
+        except requests.RequestException:
+            api_request_duration.labels(self._name, endpoint, 'error').observe(time.time() - start)
+            raise
+        code = str(r.status_code)
+        api_request_duration.labels(self._name, endpoint, code).observe(time.time() - start)
+        # Streamed bodies are not read yet, so only their announced length is known
+        size = r.headers.get('Content-Length') if stream else len(r.content)
+        if size is not None:
+            api_response_size.labels(self._name, endpoint, code).observe(int(size))
+        if r.ok:
+            api_last_success.labels(self._name, endpoint).set_to_current_time()
+        return r
+
+    def breaker(self, endpoint):
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(self._breaker_threshold, self._breaker_reset)
+            return self._breakers[endpoint]
+
+    def attempt(self, method, api_path, payload, stream):
+        service_ticket = self.ticket()
+        r = self.send(method, api_path, service_ticket, payload, stream)
+        # The ticket expired on the controller side, log in again and retry once
+        if r.status_code == 401:
+            r.close()
+            self.invalidate(service_ticket)
+            r = self.send(method, api_path, self.ticket(), payload, stream)
+        return r
+
+    def request(self, method, api_path, payload=None, stream=False):
+        endpoint = endpoint_name(api_path)
+        breaker = self.breaker(endpoint)
+        if not breaker.allow():
+            raise CircuitOpenError('Requests to {} on {} are suspended after repeated failures'.format(endpoint, self._target))
+
+        retry = 0
+        while True:
+            try:
+                r = self.attempt(method, api_path, payload, stream)
+                if r.status_code not in retry_status:
+                    break
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                r = None
+                error = e
+            if retry >= self._retries:
+                breaker.failure()
+                api_circuit_open.labels(self._name, endpoint).set(int(breaker.open))
+                if error is not None:
+                    raise error
+                r.raise_for_status()
+            if r is not None:
+                r.close()
+            # Exponential backoff, with jitter so that targets failing together do not retry together
+            time.sleep(self._backoff * 2 ** retry * random.uniform(1, 1.5))
+            retry += 1
+            api_retries.labels(self._name, endpoint).inc()
+
+        breaker.success()
+        api_circuit_open.labels(self._name, endpoint).set(0)
+        r.raise_for_status()
+        return r
+
+    def logout(self, timeout=5):
+        # Set before waiting for the lock, so requests still in flight cannot log in again
+        self._closed = True
+        with self._lock:
+            if self._service_ticket is not None:
+                try:
+                    self._session.delete(self.url('serviceTicket', self._service_ticket), timeout=timeout)
+                except requests.RequestException as e:
+                    print('Logout from {} failed: {}'.format(self._target, redact(e)))
+                self._service_ticket = None
+        if self in active_sessions:
+            active_sessions.remove(self)
+        self._session.close()
+
+
+# Fixtures are gzipped JSON files holding the API requests and responses of a crawl
+# Requests are matched by method, path and body, the service ticket is not part of the match
+# and the login credentials are never stored
+def fixture_key(request):
+    url = urllib.parse.urlsplit(request.url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(url.query) if k != 'serviceTicket']
+    path = url.path + ('?' + urllib.parse.urlencode(query) if query else '')
+    body = None
+    if request.body and not url.path.endswith('/serviceTicket'):
+        body = json.dumps(json.loads(request.body), sort_keys=True)
+    return request.method, path, body
+
+# Login response stored with a placeholder ticket, the session only needs one to replay
+def redact_ticket_response(content):
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return content
+    if isinstance(data, dict) and 'serviceTicket' in data:
+        data['serviceTicket'] = 'ST-recorded'
+    return json.dumps(data)
+
+def load_fixture(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+# Transport adapter recording every exchange of the session, while sending it to the controller
+class RecordingAdapter(HTTPAdapter):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.exchanges = []
+        self._lock = threading.Lock()
+
+    def send(self, request, *args, **kwargs):
+        start = time.time()
+        r = super().send(request, *args, **kwargs)
+        # Reading the content here keeps it available to streamed readers
+        content = r.content
+        method, path, body = fixture_key(request)
+        recorded = content.decode('utf-8', 'surrogateescape')
+        if method == 'POST' and path.endswith('/serviceTicket'):
+            recorded = redact_ticket_response(recorded)
+        with self._lock:
+            self.exchanges.append({
+                'method': method,
+                'path': path,
+                'body': body,
+                'status': r.status_code,
+                'reason': r.reason,
+                'content_type': r.headers.get('Content-Type'),
+                'content': recorded,
+                'elapsed': time.time() - start,
+            })
+        return r
+
+    def save(self, path, target):
+        with self._lock:
+            fixture = {'target': target, 'apiVersion': apiVersion, 'exchanges': list(self.exchanges)}
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump(fixture, f)
+
+# Transport adapter answering from a fixture instead of the controller
+# Repeated requests are answered with their recorded responses in order, then the last one again
+# latency scales the recorded response times, 0 answers at once
+class ReplayAdapter(BaseAdapter):
+
+    def __init__(self, fixture, latency=0):
+        super().__init__()
+        self._latency = latency
+        self._responses = {}
+        for e in fixture['exchanges']:
+            self._responses.setdefault((e['method'], e['path'], e['body']), []).append(e)
+        self._served = {}
+        self._lock = threading.Lock()
+        # Number of requests answered, and of requests missing from the fixture
+        self.requests = 0
+        self.misses = 0
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        key = fixture_key(request)
+        with self._lock:
+            self.requests += 1
+            recorded = self._responses.get(key)
+            if recorded:
+                n = self._served.get(key, 0)
+                self._served[key] = n + 1
+                e = recorded[min(n, len(recorded) - 1)]
+            else:
+                self.misses += 1
+                e = {'status': 404, 'reason': 'Not Found', 'content_type': 'application/json;charset=UTF-8', 'elapsed': 0,
+                     'content': json.dumps({'message': 'Not in fixture: {} {}'.format(*key[:2])})}
+        if self._latency > 0:
+            time.sleep(e['elapsed'] * self._latency)
+
+        # The body is read from a buffer, like from a connection, so streamed reads behave the same
+        content = e['content'].encode('utf-8', 'surrogateescape')
+        r = requests.Response()
+        r.status_code = e['status']
+        r.reason = e['reason']
+        r.raw = io.BytesIO(content)
+        r.headers = CaseInsensitiveDict({'Content-Length': str(len(content))})
+        if e['content_type']:
+            r.headers['Content-Type'] = e['content_type']
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r.url = request.url
+        r.request = request
+        return r
+
+    def close(self):
+        pass
+
+
+# Small LRU cache whose entries expire after a fixed time
+# Used for configuration objects that change far less often than the crawl runs
+class TTLCache():
+
+    def __init__(self, ttl, max_size):
+        self._ttl = ttl
+        self._max_size = max_size
+        # Entries are kept in least recently used order, each one as (expiry time, value)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < time.time():
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        # A TTL of 0 disables the cache
+        if self._ttl <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.time() + self._ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def dump(self):
+        # Unexpired entries as (key, expiry time, value), least recently used first
+        now = time.time()
+        with self._lock:
+            return [(key, expiry, value) for key, (expiry, value) in self._items.items() if expiry >= now]
+
+    def load(self, entries):
+        # Entries keep their expiry time, shortened if the TTL is now lower
+        now = time.time()
+        with self._lock:
+            for key, expiry, value in entries:
+                expiry = min(expiry, now + self._ttl)
+                if expiry >= now:
+                    self._items[key] = (expiry, value)
+                    self._items.move_to_end(key)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+
+# Fields of query/ap used by the AP metrics
+# Each AP is kept as a compact record with only these fields instead of the whole API object
+ap_fields = ('zoneName', 'apGroupName', 'apMac', 'deviceName', 'deviceGps', 'status', 'model',
+             'alerts', 'latency24G', 'latency50G', 'latency6G', 'numClients24G', 'numClients5G', 'numClients6G')
+APRecord = namedtuple('APRecord', ap_fields)
+
+def ap_record(ap):
+    return APRecord(*[ap.get(f) for f in ap_fields])
+
+# Parse a query response incrementally, turning each element of 'list' into a record as soon as it is complete
+# Only one API object is materialized at a time, the other top level keys (totalCount, hasMore...) are kept as they are
+def stream_query(response, record, chunk_size=65536):
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    chunks = response.iter_content(chunk_size=chunk_size)
+    state = {'buf': '', 'eof': False}
+
+    def read():
+        # Append the next chunk to the buffer, returning False once the body is exhausted
+        chunk = next(chunks, None)
+        if chunk is None:
+            state['buf'] += text.decode(b'', final=True)
+            state['eof'] = True
+            return False
+        state['buf'] += text.decode(chunk)
+        return True
+
+    def skip(pos):
+        # Skip whitespace and commas, reading more data when the buffer runs out
+        while True:
+            buf = state['buf']
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) or not read():
+                return pos
+
+    def value(pos):
+        # Decode the JSON value starting at pos
+        # A value not followed by a delimiter may be truncated (e.g. a number), so read more first
+        pos = skip(pos)
+        while True:
+            try:
+                obj, end = decoder.raw_decode(state['buf'], pos)
+                if state['buf'][end:end + 1] in (',', ':', ']', '}', ' ', '\t', '\r', '\n') or state['eof']:
+                    return obj, end
+            except json.JSONDecodeError:
+                if state['eof']:
+                    raise
+            read()
+
+    def expect(pos, char):
+        pos = skip(pos)
+        if state['buf'][pos:pos + 1] != char:
+            raise ValueError('Unexpected JSON in query response, expected {}'.format(char))
+        return pos + 1
+
+    result = {'list': []}
+    pos = expect(0, '{')
+    while True:
+        pos = skip(pos)
+        if state['buf'][pos:pos + 1] == '}':
+            break
+        key, pos = value(pos)
+        pos = expect(pos, ':')
+        if key == 'list':
+            pos = expect(pos, '[')
+            while True:
+                pos = skip(pos)
+                if state['buf'][pos:pos + 1] == ']':
+                    pos += 1
+                    break
+                item, pos = value(pos)
+                result['list'].append(record(item))
+                # Drop what was already parsed so the buffer stays around one chunk
+                state['buf'] = state['buf'][pos:]
+                pos = 0
+        else:
+            result[key], pos = value(pos)
+    response.close()
+    return result
+
+# Fields of query/client used by the client statistics, the clients themselves are never exported
+# Each statistic is (name, field, unit, bucket upper bounds, growth factor of the quantile bins or None for integer bins)
+client_metrics = (
+    ('rssi', 'rssi', 'dbm', (-90, -85, -80, -75, -70, -67, -60, -55, -50), None),
+    ('snr', 'snr', 'db', (5, 10, 15, 20, 25, 30, 40, 50), None),
+    ('throughput', 'txRatebps', 'bps', (6.5e6, 24e6, 54e6, 150e6, 300e6, 600e6, 1.2e9, 2.4e9), 1.02),
+)
+client_fields = ('apMac', 'ssid') + tuple(m[1] for m in client_metrics)
+ClientRecord = namedtuple('ClientRecord', client_fields)
+
+def client_record(client):
+    return ClientRecord(*[client.get(f) for f in client_fields])
+
+# Query paths kept as compact records
+query_records = {'query/ap': ap_record, 'query/client': client_record}
+
+
+# Possible AP states, exported as one series each
+ap_states = ('Online', 'Offline', 'Flagged')
+
+# Fields exported as numeric AP metrics
+ap_value_fields = ('alerts', 'latency24G', 'latency50G', 'latency6G', 'numClients24G', 'numClients5G', 'numClients6G')
+
+# Labels an AP metric family can carry, in exposition order; mac identifies the AP and is always kept
+ap_label_names = ('zone', 'ap_group', 'mac', 'name', 'lat', 'long')
+
+# AP metric families whose labels can be chosen
+ap_families = ap_value_fields + ('status', 'model')
+
+# Label sets of one AP, built once and shared by every AP metric family
+# One label set is built for each combination of labels used by the families
+# The samples of the last crawl are kept too, and reused while their value does not change
+class APRow():
+
+    __slots__ = ('key', 'labels', 'status_labels', 'model_labels', 'info_labels', 'samples', 'state', 'status_samples')
+
+    def __init__(self, key, label_sets, status_names, model_names):
+        # The key holds every field the labels are made of, to tell when they must be rebuilt
+        self.key = key
+        zone, group, mac, name, gps, model = key
+        try:
+            lat = gps.split(',')[0]
+            long = gps.split(',')[1]
+        except:
+            lat = 'none'
+            long = 'none'
+        # Wrap the values in str() to avoid issues with None values at export time
+        # Interning shares the repeated zone, group and coordinate strings between APs
+        labels = {
+            'zone': sys.intern(str(zone)),
+            'ap_group': sys.intern(str(group)),
+            'mac': str(mac),
+            'name': str(name),
+            'lat': sys.intern(str(lat)),
+            'long': sys.intern(str(long)),
+        }
+        self.labels = {names: {n: labels[n] for n in names} for names in label_sets}
+        self.status_labels = tuple(dict(self.labels[status_names], status=n) for n in ap_states)
+        self.model_labels = dict(self.labels[model_names], model=sys.intern(str(model)))
+        self.info_labels = dict(labels, model=self.model_labels['model'])
+        # Last sample of each metric name, and the state the status samples were built for
+        self.samples = {}
+        self.state = None
+        self.status_samples = ()
+
+
+# AP inventory stored as one row of labels per AP plus one array of values per metric
+# Rows are kept by MAC between crawls, so an AP whose labels did not change reuses the same label sets and samples
+# Only new APs, and APs renamed, moved or otherwise relabeled, get a new row
+# ap_labels maps each family of ap_families to the names of its labels
+class APTable():
+
+    def __init__(self, ap_labels):
+        self.ap_labels = ap_labels
+        self._label_sets = set(ap_labels.values())
+        self._rows = {}
+        self.rows = []
+        self.columns = {s: array('d') for s in ap_value_fields}
+        # Index of the AP state in ap_states, -1 for any other state
+        self.status = array('b')
+        # APs that appeared, disappeared or were relabeled since the first crawl
+        self.churn = {'new': 0, 'vanished': 0, 'changed': 0}
+
+    def update(self, records):
+        rows = {}
+        ordered = []
+        new = changed = 0
+        for ap in records:
+            key = (ap.zoneName, ap.apGroupName, ap.apMac, ap.deviceName, ap.deviceGps, ap.model)
+            row = self._rows.get(ap.apMac)
+            if row is None:
+                row = APRow(key, self._label_sets, self.ap_labels['status'], self.ap_labels['model'])
+                new += 1
+            elif row.key != key:
+                row = APRow(key, self._label_sets, self.ap_labels['status'], self.ap_labels['model'])
+                changed += 1
+            rows[ap.apMac] = row
+            ordered.append(row)
+        # The first crawl fills the table, it is not churn
+        if self._rows:
+            self.churn['new'] += new
+            self.churn['changed'] += changed
+            self.churn['vanished'] += sum(1 for mac in self._rows if mac not in rows)
+        self._rows = rows
+        self.rows = ordered
+        # Return 0 for metrics with values of None
+        self.columns = {s: array('d', [v if v is not None else 0 for v in map(attrgetter(s), records)]) for s in ap_value_fields}
+        self.status = array('b', [ap_states.index(s) if s in ap_states else -1 for s in map(attrgetter('status'), records)])
+
+    def location(self, mac):
+        # Zone and AP group of an AP, from the key of its row
+        row = self._rows.get(mac)
+        return None if row is None else row.key[:2]
+
+
+# Possible labels of the client statistics, the AP of each client gives its zone and AP group
+client_label_names = ('zone', 'ssid', 'ap_group')
+
+
+# Distribution of one client statistic: histogram buckets, plus bins precise enough to estimate quantiles
+# Integer statistics (RSSI, SNR) get one bin per value, so their quantiles are exact; the others get
+# bins growing by a constant factor, so quantiles are within that relative error
+# Its size depends on the range of the values, not on how many were added
+class Distribution():
 
+    __slots__ = ('bounds', 'growth', 'buckets', 'sum', 'count', 'bins')
+
+    def __init__(self, bounds, growth=None):
+        self.bounds = bounds
+        self.growth = growth
+        self.buckets = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+        self.bins = collections.Counter()
+
+    def add(self, values):
+        buckets = self.buckets
+        bounds = self.bounds
+        for v in values:
+            buckets[bisect_left(bounds, v)] += 1
+        self.sum += sum(values)
+        self.count += len(values)
+        if self.growth is None:
+            self.bins.update(map(round, values))
+        else:
+            scale = math.log(self.growth)
+            # Zero and negative values all fall in the lowest bin, whose value is 0
+            self.bins.update([round(math.log(v) / scale) if v > 0 else float('-inf') for v in values])
+
+    def cumulative(self):
+        # Bucket counts as exported, each including the buckets below it, the last one is +Inf
+        total = 0
+        result = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.buckets):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        if not self.count:
+            return float('nan')
+        rank = q * self.count
+        seen = 0
+        for b in sorted(self.bins):
+            seen += self.bins[b]
+            if seen >= rank:
+                break
+        return float(b) if self.growth is None else self.growth ** b
+
+
+# Client statistics of one crawl, aggregated by label set as the pages of query/client arrive
+# Pages may be added from several threads at once
+class ClientStats():
+
+    def __init__(self, label_names, locate, allowed):
+        self.label_names = label_names
+        # Zone and AP group of an AP MAC address, or None for an unknown AP
+        self._locate = locate
+        self._allowed = allowed
+        self.distributions = {}
+        self.clients = 0
+        self.unknown = 0
+        self._getters = [attrgetter(m[1]) for m in client_metrics]
+        # Location of each AP seen so far, shared by the pages
+        self._places = {}
+        self._lock = threading.Lock()
+
+    def place(self, mac):
+        # Zone and AP group of the AP, None if they are filtered out
+        location = self._locate(mac)
+        known = location is not None
+        zone, ap_group = location if known else ('', '')
+        if not self._allowed('zone', zone) or not self._allowed('ap_group', ap_group):
+            return None, known
+        return (zone, ap_group), known
+
+    def add(self, records):
+        # Group the page by AP location and SSID first, then update each distribution once per page
+        groups = {}
+        unknown = 0
+        places = self._places
+        for client in records:
+            mac = client.apMac
+            place = places.get(mac)
+            if place is None:
+                place = places[mac] = self.place(mac)
+            location, known = place
+            if not known:
+                unknown += 1
+            if location is None:
+                continue
+            key = (location, client.ssid)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = []
+            group.append(client)
+
+        # Several locations and SSIDs may share a label set, when some labels are left out
+        labeled = {}
+        for ((zone, ap_group), ssid), clients in groups.items():
+            values = {'zone': zone, 'ssid': ssid or '', 'ap_group': ap_group}
+            key = tuple(values[n] for n in self.label_names)
+            if key in labeled:
+                labeled[key].extend(clients)
+            else:
+                labeled[key] = clients
+
+        with self._lock:
+            self.unknown += unknown
+            for key, clients in labeled.items():
+                distributions = self.distributions.get(key)
+                if distributions is None:
+                    distributions = self.distributions[key] = [Distribution(m[3], m[4]) for m in client_metrics]
+                for distribution, getter in zip(distributions, self._getters):
+                    distribution.add([v for v in map(getter, clients) if isinstance(v, (int, float))])
+                self.clients += len(clients)
+
+
+# Cost of one request, in records of response, used to balance the zone shards
+shard_request_cost = 100
+
+# Split zone-filtered queries into at most `shards` units of work of similar cost
+# zones is a list of (zone, number of records); zones larger than a page are split into one item per page,
+# then the items are spread over the units largest first, each going to the least loaded unit
+# Each unit is a list of (zone, page, last page of the zone) requested one after the other
+def shard_units(zones, page_size, shards):
+    items = []
+    for zone, records in zones:
+        pages = max(1, -(-records // page_size))
+        for page in range(1, pages + 1):
+            size = max(0, min(page_size, records - (page - 1) * page_size))
+            items.append((size + shard_request_cost, (zone, page, page == pages)))
+    items.sort(key=itemgetter(0), reverse=True)
+    units = [[] for i in range(min(shards, len(items)))]
+    loads = [(0, i) for i in range(len(units))]
+    for cost, item in items:
+        load, i = heapq.heappop(loads)
+        units[i].append(item)
+        heapq.heappush(loads, (load + cost, i))
+    return units
+
+
+# Metric groups in exposition order, each one with its own refresh interval
+metric_groups = ['controller', 'zone', 'ap', 'wlan', 'details', 'client']
+
+# Create SmartZoneCollector as a class - in Python3, classes inherit object as a base class
+# Only need to specify for compatibility or in Python2
+
+class SmartZoneCollector():
+
+    # Initialize the class and specify required argument with no default value
+    # When defining class methods, must explicitly list `self` as first argument
+    def __init__(self, target, user, password, insecure, page_size=1000, page_workers=4, pool_size=16, ticket_ttl=1800, concurrency=8, timeout=30,
+                 wlan_cache_ttl=3600, scheduler_cache_ttl=3600, cache_size=1024, refresh_intervals={}, wlan_details=None, pool=None, page_pool=None, page_slots=None,
+                 stream=False, transport=None, shard_zones=False, retries=2, backoff=0.5, breaker_threshold=5, breaker_reset=60,
+                 ap_labels={}, ap_info=False, ap_status='labels', include_zones=(), exclude_zones=(), include_ap_groups=(), exclude_ap_groups=(),
+                 drift_baseline=None, drift_interval=3600, drift_max_age=86400, drift_ssids=(), drift_ignore=(),
+                 client_stats=False, client_labels=client_label_names, client_quantiles=(0.1, 0.5, 0.9), name=None):
+        # Strip any trailing "/" characters from the provided url
+        self._target = target.rstrip("/")
+        # Target label of the self-metrics, the configured name or else the URL
+        self._name = name or self._target
+        target_info.labels(self._name).info({'url': self._target})
+
+        # The session handles login, the service ticket, the connection pool, retries and circuit breakers
+        self._session = SmartZoneSession(target, user, password, insecure, pool_size, ticket_ttl, timeout, transport,
+                                         retries, backoff, breaker_threshold, breaker_reset, self._name)
+
+        # SSIDs with passphrase and schedule details, from WLAN_DETAILS unless given per target
+        if wlan_details is None:
+            wlan_details = os.environ['WLAN_DETAILS'].split(',')
+        self._wlan_details = wlan_details
+
+        # WLAN details and schedules rarely change, so they are cached per endpoint
+        self._caches = {
+            'wlans': TTLCache(wlan_cache_ttl, cache_size),
+            'wlanSchedulers': TTLCache(scheduler_cache_ttl, cache_size),
+        }
+
+        # Worker pool running the crawl requests, possibly shared with other targets
+        # The concurrency limit bounds the requests this target keeps in flight, so a slow
+        # controller cannot take every worker of a shared pool
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='smartzone-fetch')
+        self._pool = pool
+        self._concurrency = concurrency
+        # Taken for every HTTP request of a crawl or a drift comparison, query pages included
+        self._requests = threading.BoundedSemaphore(concurrency)
+
+        # Each metric group is refreshed on its own interval and served from its last build in between
+        # An interval of 0 refreshes the group on every crawl
+        # A group whose refresh fails keeps its last good metrics, and is retried on the next crawl
+        # Client statistics page through every client, so they are only collected when asked for
+        self._groups = OrderedDict((g, {'interval': refresh_intervals.get(g, 0), 'refreshed': 0, 'metrics': (), 'up': False, 'errors': 0, 'stale': 0, 'restored': False})
+                                   for g in metric_groups if g != 'client' or client_stats)
+        self._lock = threading.Lock()
+        # Whether every group refreshed by the last crawl succeeded
+        self._last_success = False
+        # AP labels kept between crawls, with the labels chosen for each AP family
+        self._ap_table = APTable({f: ap_labels.get(f, ap_label_names) for f in ap_families})
+        # Model and GPS in one info series per AP instead of the model family, and status as one series per AP
+        self._ap_info = ap_info
+        self._ap_status = ap_status
+
+        # Zones and AP groups to export, as (include, exclude) patterns
+        # Excluded zones are not requested when possible, and their metrics are left out
+        self._filters = {
+            'zone': (tuple(include_zones), tuple(exclude_zones)),
+            'ap_group': (tuple(include_ap_groups), tuple(exclude_ap_groups)),
+        }
+        self._filters = {k: v for k, v in self._filters.items() if v[0] or v[1]}
+        self._allowed = {}
+        # Last WLAN list, used to refresh the WLAN details when the WLAN group is not due
+        self._wlans = None
+        # Last good details of each WLAN, served when refreshing them fails
+        self._details = {}
+        # Labels and quantiles of the client statistics
+        self._client_labels = tuple(n for n in client_label_names if n in client_labels)
+        self._client_quantiles = tuple(client_quantiles)
+
+        # Query results are paged; pages after the first are fetched concurrently
+        # With streaming, large query responses are parsed while they are downloaded
+        self._stream = stream
+        self._page_size = page_size
+        # Pool fetching the pages, possibly shared with other targets like the worker pool
+        # The page slots bound the page workers this target takes, so a slow controller leaves the others theirs
+        if page_pool is None:
+            page_pool = ThreadPoolExecutor(max_workers=page_workers, thread_name_prefix='smartzone-page')
+        self._page_pool = page_pool
+        self._page_slots = threading.BoundedSemaphore(page_slots or page_workers)
+        # Duration of each page fetched during the last crawl, keyed by query path
+        self._page_timings = {}
+        # With sharding, query/ap and query/wlan are split into zone-filtered requests run in parallel
+        self._shard_zones = shard_zones
+
+        # Called after every crawl, e.g. to save the state file
+        self.listeners = []
+        # Unix time when the restored state was saved, 0 without a restored state
+        self._restored = 0
+
+        # Configuration drift against a baseline zone, compared in the background once started
+        self._drift = None
+        if drift_baseline:
+            self._drift = ConfigDriftMonitor(self, drift_baseline, drift_interval, drift_max_age, drift_ssids, drift_ignore)
+
+        # With the exception of uptime, all of these metrics are strings
+        # Following the example of node_exporter, we'll set these string metrics with a default value of 1
+
+    def allowed(self, kind, name):
+        # Whether a zone or AP group name passes the patterns, the answer is kept for the next APs
+        if kind not in self._filters:
+            return True
+        result = self._allowed.get((kind, name))
+        if result is None:
+            include, exclude = self._filters[kind]
+            result = ((not include or any(fnmatchcase(str(name), p) for p in include))
+                      and not any(fnmatchcase(str(name), p) for p in exclude))
+            self._allowed[(kind, name)] = result
+        return result
+
+    def get_page(self, api_path, page, filters=None):
+        # For APs, use POST and API query to reduce number of requests and improve performance
+        raw = {'page': page, 'limit': self._page_size}
+        if filters:
+            raw['filters'] = filters
+        start = time.time()
+        record = query_records.get(api_path)
+        if record is None:
+            result = self._session.request('POST', api_path, raw).json()
+        elif self._stream:
+            result = stream_query(self._session.request('POST', api_path, raw, stream=True), record)
+        else:
+            result = self._session.request('POST', api_path, raw).json()
+            result['list'] = [record(item) for item in result.get('list', [])]
+        return result, time.time() - start
+
+    # Run fn on each item on the page pool and return the results in order
+    # A request slot is taken before each item is submitted, so the page workers shared with
+    # other targets never wait for the slots of this one
+    def map_requests(self, fn, items):
+        futures = []
+        for item in items:
+            self._page_slots.acquire()
+            self._requests.acquire()
+            try:
+                future = self._page_pool.submit(fn, item)
+            except BaseException:
+                self.release_page()
+                raise
+            future.add_done_callback(lambda f: self.release_page())
+            futures.append(future)
+        return [f.result() for f in futures]
+
+    def release_page(self):
+        self._requests.release()
+        self._page_slots.release()
+
+    def get_query(self, api_path, sink=None):
+        # Without a sink the records of every page are merged in page order
+        # With a sink each page is handed to it by the worker that fetched it and dropped at once,
+        # so memory is bound by the pages in flight whatever the number of records
+        items = []
+
+        def get(page):
+            result, duration = self.get_page(api_path, page)
+            records = result.pop('list', [])
+            if sink is not None:
+                sink(records)
+                records = len(records)
+            return result, duration, records
+
+        # Returns the number of records of the page
+        def keep(records):
+            if sink is None:
+                items.extend(records)
+                return len(records)
+            return records
+
+        timings = []
+        with self._requests:
+            result, duration, records = get(1)
+        timings.append((1, duration))
+        fetched = keep(records)
+
+        # The first page tells how many records exist, so the remaining pages can be requested at once
+        # hasMore is only a hint, some controllers leave it out while totalCount says more records exist
+        # A controller capping the limit below --page-size returns that many records per page,
+        # the first page then gives the actual page size
+        total = result.get('totalCount') or 0
+        page_size = fetched if 0 < fetched < min(total, self._page_size) else self._page_size
+        last_page = -(-total // page_size)
+        page = 1
+        if total > fetched and last_page > 1:
+            pages = range(2, last_page + 1)
+            # map() keeps the page order, so the merged list matches serial paging
+            for p, (data, duration, records) in zip(pages, self.map_requests(get, pages)):
+                timings.append((p, duration))
+                fetched += keep(records)
+                result = data
+            page = last_page
+
+        # Keep paging serially if the controller did not report a usable totalCount, if it returned
+        # smaller pages than requested, or if records were added while the pages were being fetched
+        while (result.get('hasMore') or fetched < total) and records:
+            page += 1
+            with self._requests:
+                result, duration, records = get(page)
+            timings.append((page, duration))
+            fetched += keep(records)
+
+        self._page_timings[api_path] = timings
+        return {'totalCount': total, 'hasMore': False, 'list': items}
+
+    def get_shard(self, api_path, unit):
+        # Request the zone pages of one shard in turn, returning each page keyed by zone and page number
+        start = time.time()
+        parts = []
+        for zone, page, last in unit:
+            zone_index, zone_id = zone
+            filters = [{'type': 'ZONE', 'value': zone_id}]
+            with self._requests:
+                result, duration = self.get_page(api_path, page, filters)
+            parts.append(((zone_index, page), result.get('list', [])))
+            # The zone grew since its size was known, keep paging it serially
+            while last and result.get('hasMore') and result.get('list'):
+                page += 1
+                with self._requests:
+                    result, duration = self.get_page(api_path, page, filters)
+                parts.append(((zone_index, page), result.get('list', [])))
+        return parts, time.time() - start
 
     def get_data(self, api_path):
         # Add the individual URL paths for the API call
         if 'query' in api_path:
-            # For APs, use POST and API query to reduce number of requests and improve performance
-            # To-do: set dynamic AP limit based on SmartZone inventory
-            raw = {'page': 1, 'limit': 1000}
-            r = requests.post('{}/wsg/api/public/{}/{}?serviceTicket={}'.format(self._target, apiVersion, api_path, self._service_ticket), json=raw, headers=self._headers, verify=self._insecure)
+            return self.get_query(api_path)
+        with self._requests:
+            return self._session.request('GET', api_path).json()
+
+    async def fetch(self, api_path):
+        # Run the blocking request on the worker pool so other requests can proceed meanwhile
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, self.get_data, api_path)
+
+    async def fetch_cached(self, cache, api_path):
+        result = self._caches[cache].get(api_path)
+        if result is None:
+            result = await self.fetch(api_path)
+            self._caches[cache].put(api_path, result)
+        return result
+
+    async def fetch_wlan_details(self, wlan):
+        # The schedule can only be requested once the WLAN tells which scheduler it uses
+        wlan_data = await self.fetch_cached('wlans', 'rkszones/{}/wlans/{}'.format(wlan['zoneId'], wlan['wlanId']))
+        schedule = None
+        schedule_data = wlan_data.get('schedule') or {}
+        if schedule_data.get('type') not in ['AlwaysOff', 'AlwaysOn'] and schedule_data.get('id') not in [None, 'None']:
+            schedule = await self.fetch_cached('wlanSchedulers', 'rkszones/{}/wlanSchedulers/{}'.format(wlan['zoneId'], schedule_data['id']))
+        return wlan_data, schedule
+
+    async def fetch_details(self, wlans):
+        # Reuse the WLAN list of the same crawl or, when the WLAN group is not due, the last one fetched
+        if wlans is not None:
+            wlans = await wlans
+        elif self._wlans is not None:
+            wlans = self._wlans
         else:
-            r = requests.get('{}/wsg/api/public/{}/{}?serviceTicket={}'.format(self._target, apiVersion, api_path, self._service_ticket), headers=self._headers, verify=self._insecure)
-        result = r.json()
+            wlans = await self.fetch_wlans()
+        detailed = [w for w in wlans['list'] if w['ssid'] in self._wlan_details and self.allowed('zone', w['zoneName'])]
+        details = await asyncio.gather(*[self.fetch_wlan_details(w) for w in detailed], return_exceptions=True)
+        # A WLAN whose details cannot be fetched keeps its last good details, or is left out until it succeeds,
+        # and counts as stale, which leaves the group down
+        result = []
+        stale = 0
+        for wlan, detail in zip(detailed, details):
+            key = (wlan['zoneId'], wlan['wlanId'])
+            if isinstance(detail, Exception):
+                if not stopping.is_set():
+                    print('Fetching details of WLAN {} on {} failed: {}'.format(wlan['name'], self._target, redact(detail)))
+                self._groups['details']['errors'] += 1
+                stale += 1
+                detail = self._details.get(key)
+                if detail is None:
+                    continue
+            self._details[key] = detail
+            result.append((wlan, detail))
+        self._groups['details']['stale'] = stale
         return result
 
+    async def fetch_clients(self, aps):
+        # Clients are placed in the zone and AP group of their AP, from the APs of this crawl when
+        # they are being fetched, otherwise from the AP table of the last crawl
+        locate = self._ap_table.location
+        if aps is not None:
+            try:
+                aps = await aps
+            except Exception:
+                # The AP group reports its own failure
+                aps = None
+        if aps is not None:
+            locate = {ap.apMac: (ap.zoneName, ap.apGroupName) for ap in aps['list']}.get
+        stats = ClientStats(self._client_labels, locate, self.allowed)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._pool, self.get_query, 'query/client', stats.add)
+        return stats
+
+    async def fetch_sharded(self, api_path, inventory, sizes):
+        # One shard per allowed concurrent request, sized from the expected records of each zone
+        inventory = await inventory
+        zones = [((i, z['zoneId']), sizes(z)) for i, z in enumerate(inventory['list']) if self.allowed('zone', z['zoneName'])]
+        units = shard_units([(zone, size) for zone, size in zones if size is not None], self._page_size, self._concurrency)
 
-    def collect(self):
+        async def run(unit):
+            async with self._semaphore:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._pool, self.get_shard, api_path, unit)
+
+        results = await asyncio.gather(*[run(unit) for unit in units])
+        # Merge the pages in inventory order, as they would come unfiltered
+        parts = sorted((part for unit_parts, duration in results for part in unit_parts), key=itemgetter(0))
+        items = [item for key, page_items in parts for item in page_items]
+        # Page timings are kept per shard
+        self._page_timings[api_path] = [(i + 1, duration) for i, (unit_parts, duration) in enumerate(results)]
+        return {'totalCount': len(items), 'hasMore': False, 'list': items}
 
-        yield InfoMetricFamily('api_compatibility', 'Compatibility with exporter and controller', value={'compatible': str(self._compatible)})
+    async def fetch_wlans(self, inventory=None):
+        if inventory is None:
+            self._wlans = await self.fetch('query/wlan')
+        else:
+            # WLANs per zone are not in the inventory, the previous crawl tells how they are spread
+            counts = {}
+            for w in (self._wlans or {'list': []})['list']:
+                counts[w['zoneId']] = counts.get(w['zoneId'], 0) + 1
+            self._wlans = await self.fetch_sharded('query/wlan', inventory, lambda z: counts.get(z['zoneId'], 0))
+        return self._wlans
+
+    async def crawl(self, groups):
+        # Controller, inventory, APs and WLANs do not depend on each other, so they are all requested at once
+        # The WLAN details and schedules are chained after the WLAN list
+        # The semaphore belongs to the event loop of this crawl
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        # With sharding, the AP and WLAN queries wait for the zone inventory, also used by the zone group
+        tasks = {}
+        if 'controller' in groups:
+            tasks['controller'] = self.fetch('controller')
+        inventory = None
+        if 'zone' in groups or (self._shard_zones and ('ap' in groups or 'wlan' in groups)):
+            inventory = asyncio.ensure_future(self.fetch('system/inventory'))
+        if 'zone' in groups:
+            tasks['zone'] = inventory
+        aps = None
+        if 'ap' in groups:
+            if self._shard_zones:
+                # Zones without APs are skipped
+                aps = self.fetch_sharded('query/ap', inventory, lambda z: z.get('totalAPs') or None)
+            else:
+                aps = self.fetch('query/ap')
+            aps = tasks['ap'] = asyncio.ensure_future(aps)
+        wlans = None
+        if 'wlan' in groups:
+            wlans = tasks['wlan'] = asyncio.ensure_future(self.fetch_wlans(inventory if self._shard_zones else None))
+        if 'details' in groups:
+            tasks['details'] = self.fetch_details(wlans)
+        if 'client' in groups:
+            tasks['client'] = self.fetch_clients(aps)
+        # A failed group returns its exception, without stopping the others
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        return dict(zip(tasks.keys(), results))
 
+    # Build the metric families of each group from its API data
+    def build_controller(self, controllers):
         controller_metrics = {
             'model':
                 GaugeMetricFamily('smartzone_controller_model',
@@ -119,6 +1274,20 @@ class SmartZoneCollector():
                 labels=["id", "apVersion"])
                 }
 
+        # Get SmartZone controller metrics
+        for c in controllers['list']:
+            id = c['id']
+            for s in list(controller_metrics.keys()):
+                if s == 'uptimeInSec':
+                     controller_metrics[s].add_metric([id], c.get(s))
+                # Export a dummy value for string-only metrics
+                else:
+                     extra = c[s]
+                     controller_metrics[s].add_metric([id, extra], 1)
+
+        return list(controller_metrics.values())
+
+    def build_zone(self, inventory):
         zone_metrics = {
             'totalAPs':
                 GaugeMetricFamily('smartzone_zone_total_aps',
@@ -146,45 +1315,133 @@ class SmartZoneCollector():
                 labels=["zone_name","zone_id"])
                 }
 
+        # Get SmartZone inventory per zone
+        # For each zone captured from the query:
+        # - Grab the zone name and zone ID for labeling purposes
+        # - Loop through the metrics
+        # - For each status, get the value for the status in each zone and add to the metric
+        for zone in sorted(inventory['list'], key=lambda d: d['zoneName']):
+            if not self.allowed('zone', zone['zoneName']):
+                continue
+            zone_name = zone['zoneName']
+            zone_id = zone['zoneId']
+            for s in list(zone_metrics.keys()):
+                zone_metrics[s].add_metric([zone_name, zone_id], zone.get(s))
+
+        return list(zone_metrics.values())
+
+    def build_ap(self, aps):
+        # Labels chosen for each family, all of ap_label_names unless configured otherwise
+        labels = self._ap_table.ap_labels
         ap_metrics = {
             'alerts':
                 GaugeMetricFamily('smartzone_ap_alerts',
                 'Number of AP alerts',
-                labels=["zone","ap_group","mac","name","lat","long"]),
+                labels=list(labels['alerts'])),
             'latency24G':
                 GaugeMetricFamily('smartzone_ap_latency_24g_milliseconds',
                 'AP latency on 2.4G channels in milliseconds',
-                labels=["zone","ap_group","mac","name","lat","long"]),
+                labels=list(labels['latency24G'])),
             'latency50G':
                 GaugeMetricFamily('smartzone_ap_latency_5g_milliseconds',
                 'AP latency on 5G channels in milliseconds',
-                labels=["zone","ap_group","mac","name","lat","long"]),
+                labels=list(labels['latency50G'])),
             'latency6G':
                 GaugeMetricFamily('smartzone_ap_latency_6g_milliseconds',
                 'AP latency on 6G channels in milliseconds',
-                labels=["zone","ap_group","mac","name","lat","long"]),
+                labels=list(labels['latency6G'])),
             'numClients24G':
                 GaugeMetricFamily('smartzone_ap_connected_clients_24g',
                 'Number of clients connected to 2.4G channels on this AP',
-                labels=["zone","ap_group","mac","name","lat","long"]),
+                labels=list(labels['numClients24G'])),
             'numClients5G':
                 GaugeMetricFamily('smartzone_ap_connected_clients_5g',
                 'Number of clients connected to 5G channels on this AP',
-                labels=["zone","ap_group","mac","name","lat","long"]),
+                labels=list(labels['numClients5G'])),
             'numClients6G':
                 GaugeMetricFamily('smartzone_ap_connected_clients_6g',
                 'Number of clients connected to 6G channels on this AP',
-                labels=["zone","ap_group","mac","name","lat","long"]),
-            'status':
-                GaugeMetricFamily('smartzone_ap_status',
+                labels=list(labels['numClients6G'])),
+        }
+        # The status is either one series per state, or a single series holding the index of the state
+        if self._ap_status == 'enum':
+            ap_metrics['status'] = GaugeMetricFamily('smartzone_ap_state',
+                'AP state: {}, -1 for any other state'.format(', '.join('{} {}'.format(i, n) for i, n in enumerate(ap_states))),
+                labels=list(labels['status']))
+        else:
+            ap_metrics['status'] = GaugeMetricFamily('smartzone_ap_status',
                 'AP status',
-                labels=["zone","ap_group","mac","name","status","lat","long"]),
-            'model':
-                GaugeMetricFamily('smartzone_ap_model',
+                labels=list(labels['status']) + ["status"])
+        # The info series carries the model and GPS position once per AP, to be joined on mac
+        if self._ap_info:
+            ap_metrics['info'] = InfoMetricFamily('smartzone_ap',
+                'AP name, location and model',
+                labels=list(ap_label_names) + ["model"])
+        else:
+            ap_metrics['model'] = GaugeMetricFamily('smartzone_ap_model',
                 'AP model',
-                labels=["zone","ap_group","mac","name","model","lat","long"]),
-        }
+                labels=list(labels['model']) + ["model"])
+
+        # Families configured without labels are left out
+        for s in [s for s in ap_metrics if labels.get(s) == ()]:
+            del ap_metrics[s]
+
+        # Get SmartZone AP metrics
+        # Sort the records in place rather than building a sorted copy
+        records = aps['list']
+        if self._filters:
+            records = [ap for ap in records if self.allowed('zone', ap.zoneName) and self.allowed('ap_group', ap.apGroupName)]
+        records.sort(key=attrgetter('deviceName'))
+        self._ap_table.update(records)
+        rows = self._ap_table.rows
+
+        # Generate the metrics from the value columns, every family shares the label sets of the table
+        # A row keeps its previous sample while the value is the same
+        columns = dict(self._ap_table.columns)
+        if self._ap_status == 'enum':
+            columns['status'] = self._ap_table.status
+        for s, column in columns.items():
+            if s not in ap_metrics:
+                continue
+            name = ap_metrics[s].name
+            names = labels[s]
+            samples = []
+            for row, value in zip(rows, column):
+                sample = row.samples.get(name)
+                if sample is None or sample.value != value:
+                    sample = row.samples[name] = Sample(name, row.labels[names], value, None, None)
+                samples.append(sample)
+            ap_metrics[s].samples = samples
 
+        # 'Status' is a string value only, so we can't export the default value
+        # By default set value to 0 and increase to 1 to reflect current state
+        # Similar to how node_exporter handles systemd states
+        if self._ap_status != 'enum' and 'status' in ap_metrics:
+            name = ap_metrics['status'].name
+            samples = []
+            for row, state in zip(rows, self._ap_table.status):
+                if row.state != state:
+                    row.state = state
+                    row.status_samples = tuple(Sample(name, labels, 1 if state == i else 0, None, None) for i, labels in enumerate(row.status_labels))
+                samples.extend(row.status_samples)
+            ap_metrics['status'].samples = samples
+
+        # Model and info series never change value, a row builds them once
+        for s, attr in (('model', 'model_labels'), ('info', 'info_labels')):
+            if s not in ap_metrics:
+                continue
+            name = ap_metrics[s].name + ('_info' if s == 'info' else '')
+            samples = []
+            for row in rows:
+                sample = row.samples.get(name)
+                if sample is None:
+                    sample = row.samples[name] = Sample(name, getattr(row, attr), 1, None, None)
+                samples.append(sample)
+            ap_metrics[s].samples = samples
+
+        return list(ap_metrics.values())
+
+    def build_wlan(self, wlans):
         wlan_metrics = {
             'alerts':
                 GaugeMetricFamily('smartzone_wlan_alerts',
@@ -196,6 +1453,21 @@ class SmartZoneCollector():
                 labels=["zone","name","ssid"]),
         }
 
+        for wlan in sorted(wlans['list'], key=lambda d: d['name']):
+            if not self.allowed('zone', wlan['zoneName']):
+                continue
+            for s in list(wlan_metrics.keys()):
+                if wlan.get(s) in [True, False]:
+                    wlan_metrics[s].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid']], +wlan.get(s))
+                elif wlan.get(s) is not None:
+                    wlan_metrics[s].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid']], wlan.get(s))
+                # Return 0 for metrics with values of None
+                else:
+                    wlan_metrics[s].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid']], 0)
+
+        return list(wlan_metrics.values())
+
+    def build_details(self, details):
         details_metrics = {
             'passphrase':
                 GaugeMetricFamily('smartzone_wlan_details_passphrase',
@@ -207,102 +1479,29 @@ class SmartZoneCollector():
                 labels=["zone","name","ssid","schedule_name","sun","mon","tue","wed","thu","fri","sat"]),
         }
 
-        self.get_session()
+        for wlan, (wlan_data, schedule) in sorted(details, key=lambda d: d[0]['name']):
+            # Open WLANs have no passphrase, and older controllers may leave out the encryption or schedule
+            encryption = wlan_data.get('encryption') or {}
+            schedule_type = (wlan_data.get('schedule') or {}).get('type')
+            if encryption.get('method') == 'WPA2' and encryption.get('passphrase'):
+                details_metrics['passphrase'].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid'], encryption['passphrase'],
+                    'https://api.qrserver.com/v1/create-qr-code/?size=350x350&data=WIFI:T:WPA;S:{};P:{};;'.format(wlan['ssid'], urllib.parse.quote_plus(encryption['passphrase']))
+                  ], 1)
+            else:
+                details_metrics['passphrase'].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid'], "-", "-"], 0)
+            if schedule_type in ['AlwaysOff', 'AlwaysOn']:
+                details_metrics['schedule'].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid'], str(schedule_type), "-", "-", "-", "-", "-", "-", "-" ], 0)
+            elif schedule is not None:
+                details_metrics['schedule'].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid'], schedule['name'],
+                    ','.join(schedule["sun"]) if len(schedule["sun"]) > 0 else "-",
+                    ','.join(schedule["mon"]) if len(schedule["mon"]) > 0 else "-",
+                    ','.join(schedule["tue"]) if len(schedule["tue"]) > 0 else "-",
+                    ','.join(schedule["wed"]) if len(schedule["wed"]) > 0 else "-",
+                    ','.join(schedule["thu"]) if len(schedule["thu"]) > 0 else "-",
+                    ','.join(schedule["fri"]) if len(schedule["fri"]) > 0 else "-",
+                    ','.join(schedule["sat"]) if len(schedule["sat"]) > 0 else "-"
+                    ], 0)
 
-        # Get SmartZone controller metrics
-        for c in self.get_data('controller')['list']:
-            id = c['id']
-            for s in list(controller_metrics.keys()):
-                if s == 'uptimeInSec':
-                     controller_metrics[s].add_metric([id], c.get(s))
-                # Export a dummy value for string-only metrics
-                else:
-                     extra = c[s]
-                     controller_metrics[s].add_metric([id, extra], 1)
-
-        for m in controller_metrics.values():
-            yield m
-
-        # Get SmartZone inventory per zone
-        # For each zone captured from the query:
-        # - Grab the zone name and zone ID for labeling purposes
-        # - Loop through the metrics
-        # - For each status, get the value for the status in each zone and add to the metric
-        for zone in sorted(self.get_data('system/inventory')['list'], key=lambda d: d['zoneName']):
-            zone_name = zone['zoneName']
-            zone_id = zone['zoneId']
-            for s in list(zone_metrics.keys()):
-                zone_metrics[s].add_metric([zone_name, zone_id], zone.get(s))
-
-        for m in zone_metrics.values():
-            yield m
-
-        # Get SmartZone AP metrics
-        # Generate the metrics based on the values
-        for ap in sorted(self.get_data('query/ap')['list'], key=lambda d: d['deviceName']):
-            try:
-                lat = ap.get('deviceGps').split(',')[0]
-                long = ap.get('deviceGps').split(',')[1]
-            except:
-                lat = 'none'
-                long = 'none'
-            for s in list(ap_metrics.keys()):
-                # 'Status' is a string value only, so we can't export the default value
-                if s == 'status':
-                    state_name = ['Online','Offline','Flagged']
-                    # By default set value to 0 and increase to 1 to reflect current state
-                    # Similar to how node_exporter handles systemd states
-                    for n in state_name:
-                        value = 0
-                        if ap.get(s) == str(n):
-                            value = 1
-                        # Wrap the zone and group names in str() to avoid issues with None values at export time
-                        ap_metrics[s].add_metric([str(ap['zoneName']), str(ap['apGroupName']), ap['apMac'], ap['deviceName'], n, lat, long], value)
-                elif s == 'model':
-                    ap_metrics[s].add_metric([str(ap['zoneName']), str(ap['apGroupName']), ap['apMac'], ap['deviceName'], ap['model'], lat, long], 1)
-                else:
-                    if ap.get(s) is not None:
-                        ap_metrics[s].add_metric([str(ap['zoneName']), str(ap['apGroupName']), ap['apMac'], ap['deviceName'], lat, long], ap.get(s))
-                    # Return 0 for metrics with values of None
-                    else:
-                        ap_metrics[s].add_metric([str(ap['zoneName']), str(ap['apGroupName']), ap['apMac'], ap['deviceName'], lat, long], 0)
-
-        for m in ap_metrics.values():
-            yield m
-
-        for wlan in sorted(self.get_data('query/wlan')['list'], key=lambda d: d['name']):
-            for s in list(wlan_metrics.keys()):
-                if wlan.get(s) in [True, False]:
-                    wlan_metrics[s].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid']], +wlan.get(s))
-                elif wlan.get(s) is not None:
-                    wlan_metrics[s].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid']], wlan.get(s))
-                # Return 0 for metrics with values of None
-                else:
-                    wlan_metrics[s].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid']], 0)
-            if wlan['ssid'] in self._wlan_details:
-                wlan_data = self.get_data('rkszones/{}/wlans/{}'.format(wlan['zoneId'], wlan['wlanId']))
-                if wlan_data['encryption']['method'] == 'WPA2':
-                    details_metrics['passphrase'].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid'], wlan_data['encryption']['passphrase'],
-                        'https://api.qrserver.com/v1/create-qr-code/?size=350x350&data=WIFI:T:WPA;S:{};P:{};;'.format(wlan['ssid'], urllib.parse.quote_plus(wlan_data['encryption']['passphrase']))
-                      ], 1)
-                else:
-                    details_metrics['passphrase'].add_metric(str(wlan['zoneName']), str(wlan['name']), wlan['ssid'], "-", 0)
-                if wlan_data['schedule']['type'] in ['AlwaysOff', 'AlwaysOn']:
-                    details_metrics['schedule'].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid'], str(wlan_data['schedule']['type']), "-", "-", "-", "-", "-", "-", "-" ], 0)
-                elif wlan_data['schedule']['id'] != 'None':
-                    schedule = self.get_data('rkszones/{}/wlanSchedulers/{}'.format(wlan['zoneId'], wlan_data['schedule']['id']))
-                    details_metrics['schedule'].add_metric([str(wlan['zoneName']), str(wlan['name']), wlan['ssid'], schedule['name'],
-                        ','.join(schedule["sun"]) if len(schedule["sun"]) > 0 else "-",
-                        ','.join(schedule["mon"]) if len(schedule["mon"]) > 0 else "-",
-                        ','.join(schedule["tue"]) if len(schedule["tue"]) > 0 else "-",
-                        ','.join(schedule["wed"]) if len(schedule["wed"]) > 0 else "-",
-                        ','.join(schedule["thu"]) if len(schedule["thu"]) > 0 else "-",
-                        ','.join(schedule["fri"]) if len(schedule["fri"]) > 0 else "-",
-                        ','.join(schedule["sat"]) if len(schedule["sat"]) > 0 else "-"
-                        ], 0)
-
-        for m in wlan_metrics.values():
-            yield m
 
 #        for zone in sorted(self.get_data('rkszones')['list'], key=lambda d: d['name']):
 #            zone_name = zone['name']
@@ -330,9 +1529,910 @@ class SmartZoneCollector():
 #                            ','.join(schedule["sat"]) if len(schedule["sat"]) > 0 else "-" 
 #                            ], 0)
 
-        for m in details_metrics.values():
+        return list(details_metrics.values())
+
+    def build_client(self, stats):
+        labels = list(self._client_labels)
+        for i, (name, field, unit, bounds, growth) in enumerate(client_metrics):
+            # The distribution of the current clients can go down, so it is a gauge histogram
+            histogram = GaugeHistogramMetricFamily('smartzone_client_{}_{}'.format(name, unit),
+                'Distribution of the {} of the connected clients'.format(field),
+                labels=labels)
+            quantiles = GaugeMetricFamily('smartzone_client_{}_{}_quantile'.format(name, unit),
+                'Estimated quantiles of the {} of the connected clients'.format(field),
+                labels=labels + ['quantile'])
+            for key, distributions in sorted(stats.distributions.items()):
+                d = distributions[i]
+                histogram.add_metric(list(key), [(floatToGoString(b), c) for b, c in d.cumulative()], d.sum)
+                for q in self._client_quantiles:
+                    quantiles.add_metric(list(key) + [floatToGoString(q)], d.quantile(q))
+            yield histogram
+            if self._client_quantiles:
+                yield quantiles
+
+        yield GaugeMetricFamily('smartzone_clients_aggregated',
+            'Number of clients in the client statistics', value=stats.clients)
+        yield GaugeMetricFamily('smartzone_clients_unknown_ap',
+            'Number of clients whose AP was not found among the APs, exported with empty zone and AP group', value=stats.unknown)
+
+    # Run one crawl of the controller and yield the resulting metric families
+    # Only the groups due for a refresh are requested, the others are served from their last build
+    # Used directly by collect() and by SmartZonePoller to build snapshots in the background
+    def get_metrics(self):
+        self.refresh()
+        for listener in self.listeners:
+            listener()
+        yield from self.metrics()
+
+    # Crawl the groups due for a refresh
+    def refresh(self):
+
+        # Concurrent scrapes wait for the running crawl and reuse its results
+        with self._lock:
+            now = time.time()
+            due = [g for g, state in self._groups.items() if now - state['refreshed'] >= state['interval']]
+            if due:
+                try:
+                    # Make sure we are logged in, which also checks the API compatibility
+                    start = time.time()
+                    self._session.ticket()
+                    collect_phase_duration.labels(self._name, 'login').set(time.time() - start)
+
+                    # Fetch every due group concurrently before building any metric
+                    start = time.time()
+                    results = asyncio.run(self.crawl(due))
+                    collect_phase_duration.labels(self._name, 'fetch').set(time.time() - start)
+                except Exception as e:
+                    results = {g: e for g in due}
+
+                # Each group is built on its own, a failed group keeps serving its last good metrics
+                for g in due:
+                    result = results[g]
+                    if not isinstance(result, Exception):
+                        start = time.time()
+                        try:
+                            self._groups[g]['metrics'] = tuple(getattr(self, 'build_' + g)(result))
+                        except Exception as e:
+                            result = e
+                        collect_phase_duration.labels(self._name, 'build_' + g).set(time.time() - start)
+                    if isinstance(result, Exception):
+                        if not stopping.is_set():
+                            print('Refreshing {} metrics of {} failed: {}'.format(g, self._target, redact(result)))
+                        self._groups[g]['up'] = False
+                        self._groups[g]['errors'] += 1
+                    else:
+                        # A group built partly from the last good data of failed objects is served but not up,
+                        # and stays due so that they are tried again by the next crawl
+                        self._groups[g]['up'] = not self._groups[g]['stale']
+                        self._groups[g]['restored'] = False
+                        if self._groups[g]['up']:
+                            self._groups[g]['refreshed'] = now
+                self._last_success = all(self._groups[g]['up'] for g in due)
+
+    # Metric families of the last refresh of every group, without crawling
+    def metrics(self):
+        with self._lock:
+            groups = [(g, state['refreshed'], state['interval'], state['metrics'], state['up'], state['errors'], state['restored'])
+                      for g, state in self._groups.items()]
+
+        yield InfoMetricFamily('api_compatibility', 'Compatibility with exporter and controller', value={'compatible': str(self._session.compatible)})
+
+        for g, refreshed, interval, metrics, up, errors, restored in groups:
+            for m in metrics:
+                yield m
+
+        # Refresh cadence of each group
+        group_refreshed = GaugeMetricFamily('smartzone_exporter_group_last_refresh_timestamp_seconds',
+            'Unix time when the metric group was last refreshed',
+            labels=["group"])
+        group_interval = GaugeMetricFamily('smartzone_exporter_group_refresh_interval_seconds',
+            'Configured refresh interval of the metric group',
+            labels=["group"])
+        # Health of each group, a group that is down serves the metrics of its last refresh
+        group_up = GaugeMetricFamily('smartzone_exporter_group_up',
+            'Whether the last refresh of the metric group succeeded, 0 when some WLAN details were served from an earlier refresh',
+            labels=["group"])
+        group_errors = CounterMetricFamily('smartzone_exporter_group_errors',
+            'Number of failed refreshes of the metric group, and of WLANs whose details failed',
+            labels=["group"])
+        # Metrics loaded from the state file at startup are served until the group is refreshed
+        group_restored = GaugeMetricFamily('smartzone_exporter_group_restored',
+            'Whether the metric group serves metrics restored from the state file, not refreshed since the start',
+            labels=["group"])
+        for g, refreshed, interval, metrics, up, errors, restored in groups:
+            group_refreshed.add_metric([g], refreshed)
+            group_interval.add_metric([g], interval)
+            group_up.add_metric([g], int(up))
+            group_errors.add_metric([g], errors)
+            group_restored.add_metric([g], int(restored))
+        yield group_refreshed
+        yield group_interval
+        yield group_up
+        yield group_errors
+        yield group_restored
+
+        # Timing of every query page fetched during the last crawl
+        page_metrics = GaugeMetricFamily('smartzone_exporter_query_page_duration_seconds',
+            'Duration of each query page request during the last crawl',
+            labels=["path","page"])
+        page_count = GaugeMetricFamily('smartzone_exporter_query_pages',
+            'Number of query pages fetched during the last crawl',
+            labels=["path"])
+        for path, timings in sorted(self._page_timings.items()):
+            page_count.add_metric([path], len(timings))
+            for page, duration in timings:
+                page_metrics.add_metric([path, str(page)], duration)
+        yield page_count
+        yield page_metrics
+
+        # AP inventory churn, every new or relabeled AP adds a set of series
+        ap_changes = CounterMetricFamily('smartzone_exporter_ap_changes',
+            'Number of APs that appeared (new), disappeared (vanished) or changed labels (changed) since the first crawl',
+            labels=["change"])
+        for change, count in self._ap_table.churn.items():
+            ap_changes.add_metric([change], count)
+        yield ap_changes
+
+        # Hit ratio and size of the configuration caches
+        cache_metrics = {
+            'hits':
+                CounterMetricFamily('smartzone_exporter_cache_hits',
+                'Number of cache lookups answered from the cache',
+                labels=["cache"]),
+            'misses':
+                CounterMetricFamily('smartzone_exporter_cache_misses',
+                'Number of cache lookups that required an API request',
+                labels=["cache"]),
+            'evictions':
+                CounterMetricFamily('smartzone_exporter_cache_evictions',
+                'Number of entries evicted to keep the cache size bound',
+                labels=["cache"]),
+        }
+        cache_entries = GaugeMetricFamily('smartzone_exporter_cache_entries',
+            'Number of entries currently in the cache',
+            labels=["cache"])
+        for name, cache in self._caches.items():
+            for s in list(cache_metrics.keys()):
+                cache_metrics[s].add_metric([name], getattr(cache, s))
+            cache_entries.add_metric([name], len(cache))
+        for m in cache_metrics.values():
             yield m
+        yield cache_entries
 
+        # Result of the last configuration comparison, it never runs during a crawl
+        if self._drift is not None:
+            yield from self._drift.collect()
+
+    # What a restarted exporter needs to serve the target at once and to refresh it without refetching everything
+    # Pickled under the lock, so a crawl cannot change it halfway through; None if a crawl holds the lock past the timeout
+    def state(self, timeout=-1):
+        if not self._lock.acquire(timeout=timeout):
+            return None
+        try:
+            return pickle.dumps({
+                'version': state_version,
+                'target': self._target,
+                'saved': time.time(),
+                'compatible': self._session.compatible,
+                'groups': {g: {'refreshed': s['refreshed'], 'metrics': s['metrics'], 'up': s['up']}
+                           for g, s in self._groups.items() if s['refreshed']},
+                'caches': {name: cache.dump() for name, cache in self._caches.items()},
+                'wlans': self._wlans,
+                'details': self._details,
+                'drift': self._drift.state() if self._drift is not None else None,
+            }, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            self._lock.release()
+
+    def restore(self, state):
+        # The groups keep their refresh time, so only the groups already due are refreshed by the first crawl
+        with self._lock:
+            self._session.compatible = state['compatible']
+            for g, s in state['groups'].items():
+                if g in self._groups:
+                    self._groups[g].update(s, restored=True)
+            for name, entries in state['caches'].items():
+                if name in self._caches:
+                    self._caches[name].load(entries)
+            self._wlans = state['wlans']
+            self._details = state['details']
+            self._restored = state['saved']
+        if self._drift is not None and state['drift'] is not None:
+            self._drift.restore(state['drift'])
+
+    def collect(self):
+        # Without a poller the whole crawl happens inside the scrape
+        yield from self.get_metrics()
+
+
+# Background poller that keeps the latest crawl as an immutable snapshot
+# Scrapes only return the snapshot, so the controller load no longer depends on
+# how many Prometheus servers scrape the exporter or how often they do it
+class SmartZonePoller():
+
+    def __init__(self, collector, interval, live_age=True):
+        self._collector = collector
+        self._target = collector._target
+        self._name = collector._name
+        self._interval = interval
+        # The age changes on every read, so it is left out when the exposition is pre-rendered
+        self._live_age = live_age
+        # Called after every poll, e.g. to render the exposition of the new snapshot
+        self.listeners = []
+
+        # The snapshot is a tuple of metric families together with its build time and duration
+        # It is replaced as a whole, so readers never see a half-built crawl
+        self._snapshot = ((), 0, 0)
+        # A restored state is served until the first poll, with the time it was saved
+        if collector._restored:
+            self._snapshot = (tuple(collector.metrics()), collector._restored, 0)
+        self._last_success = False
+        self._polls = 0
+        self._failures = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='smartzone-poller', daemon=True)
+
+    def poll(self):
+        start = time.time()
+        self._polls += 1
+        try:
+            # Materialize the whole crawl before publishing it
+            metrics = tuple(self._collector.get_metrics())
+        except Exception as e:
+            self._failures += 1
+            self._last_success = False
+            if not stopping.is_set():
+                print('Polling {} failed: {}'.format(self._target, redact(e)))
+        else:
+            end = time.time()
+            self._snapshot = (metrics, end, end - start)
+            # Failed groups are served from their last refresh, the poll only succeeds if every group refreshed
+            self._last_success = self._collector._last_success
+            if not self._last_success:
+                self._failures += 1
+        for listener in self.listeners:
+            listener()
+
+    def run(self):
+        while not self._stop.is_set():
+            start = time.time()
+            self.poll()
+            # Keep a steady cadence, waiting only for what is left of the interval
+            self._stop.wait(max(0, self._interval - (time.time() - start)))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def collect(self):
+        metrics, timestamp, duration = self._snapshot
+
+        for m in metrics:
+            yield m
+
+        # Snapshot status metrics, useful to alert when the poller falls behind
+        yield GaugeMetricFamily('smartzone_exporter_snapshot_timestamp_seconds',
+            'Unix time when the current snapshot was built, 0 if no poll succeeded yet', value=timestamp)
+        if self._live_age:
+            yield GaugeMetricFamily('smartzone_exporter_snapshot_age_seconds',
+                'Age of the current snapshot in seconds', value=time.time() - timestamp if timestamp else float('inf'))
+        yield GaugeMetricFamily('smartzone_exporter_poll_duration_seconds',
+            'Duration of the crawl that built the current snapshot', value=duration)
+        yield GaugeMetricFamily('smartzone_exporter_poll_interval_seconds',
+            'Configured interval between background polls', value=self._interval)
+        yield GaugeMetricFamily('smartzone_exporter_last_poll_success',
+            'Whether the last background poll refreshed every metric group', value=int(self._last_success))
+        yield CounterMetricFamily('smartzone_exporter_polls',
+            'Total number of background polls', value=self._polls)
+        yield CounterMetricFamily('smartzone_exporter_poll_failures',
+            'Total number of background polls that failed or left a metric group stale', value=self._failures)
+
+
+
+# Background comparison of every zone and WLAN configuration with the ones of a baseline zone
+# It runs on its own slow cadence, scrapes only read the result of the last run
+# Configurations are kept between runs and fetched again only when the lastModifiedTime of the
+# WLAN listing changes, or after max_age seconds; a comparison is only redone when one of its two sides changed
+# Schedules and portals have no version in the listing and are fetched on every run
+# A zone or WLAN that fails to fetch keeps its last comparison, or gets the error status, only a failure
+# of the baseline zone fails the whole run
+class ConfigDriftMonitor():
+
+    def __init__(self, collector, baseline, interval=3600, max_age=86400, ssids=(), ignore=()):
+        self._collector = collector
+        self._session = collector._session
+        self._target = collector._target
+        self._baseline = baseline
+        self._interval = interval
+        self._max_age = max_age
+        self._ssids = set(ssids)
+        # Zone rows leave the zone name out, it always differs from the baseline one
+        self._engines = drift_engines(ignore_patterns(ignore))
+
+        # Configurations by API path, as (version, fetch time, data)
+        self._configs = {}
+        # Drift rows by (zone id, ssid), with the versions of both sides they were computed from
+        self._rows = {}
+        self._used = set()
+        self._lock = threading.Lock()
+        self._result = ((), 0, 0, False)
+        self._objects = {'fetched': 0, 'reused': 0, 'failed': 0}
+        self._runs = 0
+        self._failures = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='smartzone-drift', daemon=True)
+
+    def get(self, path, version=None):
+        with self._lock:
+            self._used.add(path)
+            cached = self._configs.get(path)
+            if cached is not None and version is not None and cached[0] == version and time.time() - cached[1] < self._max_age:
+                self._objects['reused'] += 1
+                return cached[2]
+        data = self._session.request('GET', path).json()
+        with self._lock:
+            self._objects['fetched'] += 1
+            self._configs[path] = (version, time.time(), data)
+        return data
+
+    def zone_config(self, zone):
+        # Zones are not versioned in the inventory, the fetched lastModifiedTime decides whether to compare again
+        config = self.get('rkszones/{}'.format(zone['zoneId']))
+        return config, config.get('lastModifiedTime')
+
+    def zone_wlans(self, zone):
+        wlans = self._session.request('GET', 'rkszones/{}/wlans'.format(zone['zoneId'])).json()['list']
+        return [w for w in wlans if not self._ssids or w['ssid'] in self._ssids]
+
+    def wlan_config(self, zone, wlan):
+        # Schedules and portals are fetched on every run, a change of theirs leaves the WLAN lastModifiedTime as is,
+        # so the version of the comparison also covers their content
+        version = wlan.get('lastModifiedTime')
+        config = get_wlan_config(self.get, zone['zoneId'], wlan['id'], version)
+        if version is not None:
+            linked = json.dumps([config.get('scheduler_config'), config.get('portal_config')], sort_keys=True)
+            version = (version, hashlib.sha1(linked.encode('utf-8')).hexdigest())
+        return config, version
+
+    def row(self, kind, zone, ssid, baseline, config, error=None):
+        # Versions of None always compare again, nothing tells whether the object changed
+        key = (zone['zoneId'], ssid)
+        versions = (baseline and baseline[1], config and config[1])
+        previous = self._rows.get(key)
+        if error is not None:
+            return previous[1] if previous is not None else drift_row(self._engines[kind], kind, zone['zoneName'], ssid, None, None, error)
+        if previous is not None and None not in versions and previous[0] == versions:
+            return previous[1]
+        row = drift_row(self._engines[kind], kind, zone['zoneName'], ssid, baseline and baseline[0], config and config[0])
+        self._rows[key] = (versions, row)
+        return row
+
+    def compare(self):
+        # Paths requested by this run, the other configurations are dropped at the end
+        self._used = set()
+        # Requests are bounded by the concurrency of the target and run on its page pool
+        collector = self._collector
+        with collector._requests:
+            inventory = self._session.request('GET', 'system/inventory').json()['list']
+        zones = [z for z in inventory if self._collector.allowed('zone', z['zoneName']) or z['zoneName'] == self._baseline]
+        baseline_zone = next((z for z in zones if z['zoneName'] == self._baseline), None)
+        if baseline_zone is None:
+            raise ValueError('Baseline zone {} not found on {}'.format(self._baseline, self._target))
+
+        zone_configs = collector.map_requests(isolated(self.zone_config), zones)
+        zone_wlans = collector.map_requests(isolated(self.zone_wlans), zones)
+        baseline_index = zones.index(baseline_zone)
+        for result, error in (zone_configs[baseline_index], zone_wlans[baseline_index]):
+            if error is not None:
+                raise error
+        wanted = [(z, w) for z, (wlans, error) in zip(zones, zone_wlans) if error is None for w in wlans]
+        wlan_configs = collector.map_requests(isolated(lambda zw: self.wlan_config(*zw)), wanted)
+
+        # Failures by (zone id, ssid), the empty ssid standing for the WLAN listing of the zone
+        configs = {}
+        errors = {}
+        for z, (wlans, error) in zip(zones, zone_wlans):
+            if error is not None:
+                errors[(z['zoneId'], '')] = error
+        for (z, w), (config, error) in zip(wanted, wlan_configs):
+            if error is not None:
+                errors[(z['zoneId'], w['ssid'])] = error
+            configs[(z['zoneId'], w['ssid'])] = config
+        failures = [error for config, error in zone_configs if error is not None] + list(errors.values())
+        baseline_config = zone_configs[baseline_index][0]
+        baseline_ssids = set(ssid for zone_id, ssid in configs if zone_id == baseline_zone['zoneId']) | self._ssids
+
+        # The hashes of the previous run refer to configurations that may have been replaced
+        for engine in self._engines.values():
+            engine.clear()
+        rows = []
+        # Zone of each row
+        compared = []
+        for z, (config, error) in zip(zones, zone_configs):
+            if z is baseline_zone:
+                continue
+            rows.append(self.row('zone', z, '', baseline_config, config, error))
+            compared.append(z)
+            ssids = baseline_ssids | set(ssid for zone_id, ssid in configs if zone_id == z['zoneId'])
+            # The WLANs of a zone that could not be listed are the ones of its last comparison
+            listing_error = errors.get((z['zoneId'], ''))
+            if listing_error is not None:
+                ssids |= set(ssid for zone_id, ssid in self._rows if zone_id == z['zoneId'] and ssid)
+            for ssid in sorted(ssids):
+                error = listing_error or errors.get((z['zoneId'], ssid)) or errors.get((baseline_zone['zoneId'], ssid))
+                rows.append(self.row('wlan', z, ssid, configs.get((baseline_zone['zoneId'], ssid)), configs.get((z['zoneId'], ssid)), error))
+                compared.append(z)
+
+        # Forget the configurations and comparisons of objects that no longer exist
+        with self._lock:
+            self._configs = {path: c for path, c in self._configs.items() if path in self._used}
+        keys = set((z['zoneId'], row['ssid']) for z, row in zip(compared, rows))
+        self._rows = {key: r for key, r in self._rows.items() if key in keys}
+        if failures:
+            with self._lock:
+                self._objects['failed'] += len(failures)
+            if not stopping.is_set():
+                print('Comparing configurations of {} with {}: {} objects failed to fetch, their rows keep the last comparison or the error status, first error: {}'.format(
+                    self._target, self._baseline, len(failures), redact(failures[0])))
+        return rows
+
+    def poll(self):
+        start = time.time()
+        self._runs += 1
+        try:
+            rows = tuple(self.compare())
+        except Exception as e:
+            self._failures += 1
+            self._result = self._result[:3] + (False,)
+            if not stopping.is_set():
+                print('Comparing configurations of {} with {} failed: {}'.format(self._target, self._baseline, redact(e)))
+        else:
+            end = time.time()
+            self._result = (rows, end, end - start, True)
+
+    def state(self):
+        with self._lock:
+            return {'baseline': self._baseline, 'configs': dict(self._configs), 'rows': dict(self._rows), 'result': self._result}
+
+    def restore(self, state):
+        # Comparisons with another baseline cannot be reused
+        if state['baseline'] != self._baseline:
+            return
+        with self._lock:
+            self._configs = state['configs']
+        self._rows = state['rows']
+        self._result = state['result']
+
+    def run(self):
+        # A restored result is only compared again once it is due
+        timestamp = self._result[1]
+        if timestamp:
+            self._stop.wait(max(0, self._interval - (time.time() - timestamp)))
+        while not self._stop.is_set():
+            start = time.time()
+            self.poll()
+            self._stop.wait(max(0, self._interval - (time.time() - start)))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def collect(self):
+        rows, timestamp, duration, up = self._result
+
+        drift = GaugeMetricFamily('smartzone_config_drift',
+            'Number of settings of the zone or WLAN that differ from the baseline zone, by configuration group',
+            labels=["zone","ssid","group"])
+        status = GaugeMetricFamily('smartzone_config_drift_status',
+            'Comparison with the baseline zone: ok, drift, missing (in the zone), extra (not in the baseline) or error (not fetched, no earlier comparison)',
+            labels=["zone","ssid","status"])
+        for row in rows:
+            status.add_metric([row['zone'], row['ssid'], row['status']], 1)
+            for group, count in sorted(row['groups'].items()):
+                drift.add_metric([row['zone'], row['ssid'], group], count)
+        yield drift
+        yield status
+
+        yield InfoMetricFamily('smartzone_config_drift_baseline', 'Zone the configurations are compared with', value={'zone': self._baseline})
+        yield GaugeMetricFamily('smartzone_exporter_config_drift_timestamp_seconds',
+            'Unix time when the configurations were last compared, 0 if no comparison succeeded yet', value=timestamp)
+        yield GaugeMetricFamily('smartzone_exporter_config_drift_duration_seconds',
+            'Duration of the last successful comparison', value=duration)
+        yield GaugeMetricFamily('smartzone_exporter_config_drift_up',
+            'Whether the last comparison succeeded', value=int(up))
+        yield CounterMetricFamily('smartzone_exporter_config_drift_runs',
+            'Total number of comparisons', value=self._runs)
+        yield CounterMetricFamily('smartzone_exporter_config_drift_failures',
+            'Total number of comparisons that failed', value=self._failures)
+        objects = CounterMetricFamily('smartzone_exporter_config_drift_objects',
+            'Configuration objects fetched from the controller, reused from the previous comparison or that failed to fetch',
+            labels=["result"])
+        for result, count in self._objects.items():
+            objects.add_metric([result], count)
+        yield objects
+
+
+# State file format, a file of another version is ignored
+state_version = 1
+
+# Keyed by the configured target name, targets sharing a controller URL may differ in their options
+def state_path(directory, name):
+    return os.path.join(directory, '{}.state'.format(hashlib.sha1(name.encode('utf-8')).hexdigest()))
+
+def save_state(path, data):
+    # Written to a temporary file then renamed, so a crash never leaves a truncated state
+    # mkstemp gives every save its own file, only readable by the owner since the metrics include the WLAN passphrases
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def load_state(path, target):
+    # Returns None when there is no usable state for the target
+    # The metrics are many small objects, collecting garbage while they are created doubles the load time
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print('Ignoring state file {}: {}'.format(path, e))
+        return None
+    finally:
+        if enabled:
+            gc.enable()
+    if not isinstance(state, dict) or state.get('version') != state_version or state.get('target') != target:
+        return None
+    return state
+
+
+# Saves the state of a target after a crawl, at most once per interval
+class StateWriter():
+
+    def __init__(self, collector, path, interval):
+        self._collector = collector
+        self._path = path
+        self._interval = interval
+        self._saved = 0
+
+    def __call__(self):
+        if time.time() - self._saved >= self._interval:
+            self.save()
+
+    def save(self, timeout=-1):
+        try:
+            data = self._collector.state(timeout)
+            if data is None:
+                print('Saving state of {} skipped, a crawl is running'.format(self._collector._target))
+                return
+            save_state(self._path, data)
+            self._saved = time.time()
+        except Exception as e:
+            print('Saving state of {} failed: {}'.format(self._collector._target, e))
+
+
+# Longest wait between two attempts of a push, the receiver of a remote site may stay unreachable for long
+push_max_backoff = 60
+
+# Pushgateway grouping key as URL path, values that cannot be path segments are base64 encoded
+def grouping_path(labels):
+    parts = []
+    for name, value in labels:
+        if not value or '/' in value:
+            parts.append('{}@base64/{}'.format(name, base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii') or '='))
+        else:
+            parts.append('{}/{}'.format(name, urllib.parse.quote(value, safe='')))
+    return '/'.join(parts)
+
+
+# Push mode, for controllers that Prometheus cannot scrape, e.g. behind NAT at a remote site
+# Writers are poller listeners: the poll only queues its samples and a sender thread delivers them,
+# retrying connection errors, timeouts, throttling and server errors with backoff
+class PushWriter():
+
+    def __init__(self, poller, url, retries=5, backoff=1, timeout=30, verify=True):
+        self._poller = poller
+        self._target = poller._target
+        self._name = poller._name
+        self._url = url
+        self._retries = retries
+        self._backoff = backoff
+        self._timeout = timeout
+        self._session = requests.Session()
+        self._session.verify = verify
+        if os.environ.get('PUSH_USER'):
+            self._session.auth = (os.environ['PUSH_USER'], os.environ.get('PUSH_PASSWORD', ''))
+        self._thread = threading.Thread(target=self.run, name='smartzone-push', daemon=True)
+
+    # Returns whether the receiver accepted the body
+    def deliver(self, method, url, body, headers, samples):
+        retry = 0
+        while True:
+            try:
+                r = self._session.request(method, url, data=body, headers=headers, timeout=self._timeout)
+                r.close()
+                if r.status_code < 300:
+                    push_requests.labels(self._name, 'success').inc()
+                    push_samples.labels(self._name).inc(samples)
+                    push_bytes.labels(self._name).inc(len(body))
+                    push_last_success.labels(self._name).set_to_current_time()
+                    return True
+                # The receiver refused the content, sending it again would not help
+                if r.status_code < 500 and r.status_code != 429:
+                    push_requests.labels(self._name, 'rejected').inc()
+                    print('Push of {} to {} rejected: {} {}'.format(self._target, url, r.status_code, r.text[:200].strip()))
+                    return False
+                error = 'HTTP {}'.format(r.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if retry >= self._retries:
+                push_requests.labels(self._name, 'failed').inc()
+                print('Push of {} to {} failed: {}'.format(self._target, url, error))
+                return False
+            push_requests.labels(self._name, 'retry').inc()
+            time.sleep(min(self._backoff * 2 ** retry, push_max_backoff) * random.uniform(1, 1.5))
+            retry += 1
+
+    def start(self):
+        self._thread.start()
+
+
+# Prometheus remote write of every poll, in batches of snappy-compressed WriteRequests
+# Only series whose value changed are sent, unchanged ones are sent again every resend seconds so the
+# receiver never considers them stale, and series that disappeared get a staleness marker
+class RemoteWriter(PushWriter):
+
+    def __init__(self, poller, url, labels, batch_size=2000, queue_size=200, resend=120, **options):
+        super().__init__(poller, url, **options)
+        # External labels added to every series, the labels of the series win on conflict
+        self._labels = labels
+        self._batch_size = batch_size
+        self._queue_size = queue_size
+        self._resend = resend
+        # Series key -> [encoded labels, last value pushed, push time]
+        self._series = {}
+        # Set when pushed samples were lost, the next poll then sends every series
+        self._resync = False
+        # Encoded batches with their sample count, the oldest are dropped when the queue is full
+        self._queue = collections.deque()
+        self._ready = threading.Condition()
+
+    def __call__(self):
+        now = time.time()
+        timestamp = int(now * 1000)
+        # Series pushed before this time are sent even if unchanged
+        resend = now if self._resync else now - self._resend
+        self._resync = False
+        previous = self._series
+        series = {}
+        batch = []
+        for family in self._poller.collect():
+            for s in family.samples:
+                key = (s.name, tuple(s.labels.items()))
+                entry = previous.get(key)
+                if entry is None:
+                    labels = dict(self._labels)
+                    labels.update(s.labels)
+                    labels['__name__'] = s.name
+                    entry = [remotewrite.encode_labels(labels.items()), None, 0]
+                series[key] = entry
+                value = s.value
+                # NaN never equals itself, an unchanged NaN is compared with itself as well
+                if entry[2] > resend and (value == entry[1] or (value != value and entry[1] != entry[1])):
+                    continue
+                entry[1] = value
+                entry[2] = now
+                batch.append(remotewrite.encode_series(entry[0], value, timestamp))
+                if len(batch) >= self._batch_size:
+                    self.enqueue(batch)
+                    batch = []
+        # Without the marker, Prometheus would keep serving a removed AP for 5 minutes
+        for key, entry in previous.items():
+            if key not in series:
+                batch.append(remotewrite.encode_series(entry[0], remotewrite.stale_nan, timestamp))
+                if len(batch) >= self._batch_size:
+                    self.enqueue(batch)
+                    batch = []
+        if batch:
+            self.enqueue(batch)
+        self._series = series
+
+    def enqueue(self, batch):
+        body = remotewrite.encode_write_request(batch)
+        with self._ready:
+            if len(self._queue) >= self._queue_size:
+                self._queue.popleft()
+                push_dropped.labels(self._name).inc()
+                self._resync = True
+            self._queue.append((body, len(batch)))
+            push_queue.labels(self._name).set(len(self._queue))
+            self._ready.notify()
+
+    def run(self):
+        # A single sender keeps the batches in order, receivers reject samples older than the last one of a series
+        while True:
+            with self._ready:
+                while not self._queue:
+                    self._ready.wait()
+                body, samples = self._queue.popleft()
+                push_queue.labels(self._name).set(len(self._queue))
+            if not self.deliver('POST', self._url, remotewrite.compress(body), remotewrite.headers, samples):
+                self._resync = True
+
+
+# Push of the whole snapshot to a Pushgateway, replacing the previous push of the same grouping key
+# Only the latest snapshot matters, a push still running when polls complete sends the newest one next
+class PushgatewayWriter(PushWriter):
+
+    def __init__(self, poller, url, grouping, **options):
+        super().__init__(poller, '{}/metrics/{}'.format(url.rstrip('/'), grouping_path(grouping)), **options)
+        self._pending = threading.Event()
+
+    def __call__(self):
+        self._pending.set()
+
+    def run(self):
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+            metrics = list(self._poller.collect())
+            registry = CollectorRegistry(auto_describe=False)
+            registry.register(StaticCollector(metrics))
+            body = gzip.compress(generate_latest(registry))
+            self.deliver('PUT', self._url, body, {'Content-Type': CONTENT_TYPE_LATEST, 'Content-Encoding': 'gzip'},
+                         sum(len(m.samples) for m in metrics))
+
+
+# Minimal collector wrapping metric families that were already collected
+class StaticCollector():
+
+    def __init__(self, metrics):
+        self._metrics = metrics
+
+    def collect(self):
+        return self._metrics
+
+
+# Probe status of a polled target, for probes served from the pre-rendered exposition
+class ProbeStatusCollector():
+
+    def __init__(self, poller):
+        self._poller = poller
+
+    def collect(self):
+        yield GaugeMetricFamily('probe_success', 'Whether the probe of the target succeeded', value=int(self._poller._last_success))
+
+
+# Exposition of a registry rendered once per snapshot and served byte for byte to every scraper
+# The text, OpenMetrics and gzip variants are all prepared when the snapshot changes,
+# so a scrape costs no serialization nor compression
+class ExpositionCache():
+
+    def __init__(self, registry):
+        self._registry = registry
+        # Rendered variants keyed by (openmetrics, gzip), with their ETag and modification time
+        self._rendered = None
+
+    def refresh(self):
+        text = generate_latest(self._registry)
+        openmetrics = openmetrics_generate_latest(self._registry)
+        rendered = {
+            (False, False): text,
+            (False, True): gzip.compress(text),
+            (True, False): openmetrics,
+            (True, True): gzip.compress(openmetrics),
+        }
+        # The ETag only depends on the content, so an unchanged snapshot keeps its ETag
+        # It is weak since the same content is served in several encodings
+        etag = 'W/"{:08x}"'.format(zlib.crc32(text))
+        self._rendered = (rendered, etag, formatdate(time.time(), usegmt=True))
+
+    def serve(self, environ, start_response, extra_headers=[]):
+        # Returns None until the first snapshot was rendered, or for filtered scrapes
+        rendered = self._rendered
+        if rendered is None or 'name[]' in environ.get('QUERY_STRING', ''):
+            return None
+        variants, etag, last_modified = rendered
+
+        headers = [('ETag', etag), ('Last-Modified', last_modified), ('Vary', 'Accept, Accept-Encoding')] + extra_headers
+        if environ.get('HTTP_IF_NONE_MATCH') == etag or environ.get('HTTP_IF_MODIFIED_SINCE') == last_modified:
+            start_response('304 Not Modified', headers)
+            return [b'']
+
+        encoder, content_type = choose_encoder(environ.get('HTTP_ACCEPT'))
+        openmetrics = content_type != CONTENT_TYPE_LATEST
+        compressed = 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')
+        body = variants[(openmetrics, compressed)]
+        headers.append(('Content-Type', content_type))
+        if compressed:
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        return [body]
+
+
+# Request handler that does not log every scrape
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+# WSGI application serving the exporter registry on /metrics and one target per request on /probe
+# Targets are looked up by name or URL among the configured ones, so the exporter never sends
+# controller credentials to an arbitrary URL given in the query string
+# Pre-rendered expositions are looked up in caches, by target name and under '/metrics' for the registry
+def make_exporter_app(targets, caches={}):
+    metrics_app = make_wsgi_app(REGISTRY)
+
+    # Allow looking up a target both by its name and by its URL
+    lookup = {}
+    for name, collector in targets.items():
+        lookup[name] = name
+        lookup[collector._target] = name
+
+    def app(environ, start_response):
+        if environ['PATH_INFO'] != '/probe':
+            if '/metrics' in caches:
+                body = caches['/metrics'].serve(environ, start_response)
+                if body is not None:
+                    return body
+            return metrics_app(environ, start_response)
+
+        params = urllib.parse.parse_qs(environ['QUERY_STRING'])
+        target = params.get('target', [''])[0]
+        name = lookup.get(target) or lookup.get(target.rstrip('/'))
+        if name is None:
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return ['Unknown target {}\n'.format(target).encode('utf-8')]
+        collector = targets[name]
+
+        if name in caches:
+            body = caches[name].serve(environ, start_response)
+            if body is not None:
+                return body
+
+        start = time.time()
+        try:
+            metrics = list(collector.collect())
+            # Failed groups still serve their last metrics, so the probe succeeds only if every group refreshed
+            # With a poller the probe only reads the snapshot, so report the last poll instead
+            success = int(collector._last_success)
+        except Exception as e:
+            print('Probe of {} failed: {}'.format(target, redact(e)))
+            metrics = []
+            success = 0
+        # Same probe status metrics as the blackbox exporter
+        metrics.append(GaugeMetricFamily('probe_success', 'Whether the probe of the target succeeded', value=success))
+        metrics.append(GaugeMetricFamily('probe_duration_seconds', 'Duration of the probe in seconds', value=time.time() - start))
+
+        registry = CollectorRegistry(auto_describe=False)
+        registry.register(StaticCollector(metrics))
+        return make_wsgi_app(registry)(environ, start_response)
+
+    return app
+
+
+# Read the static multi-target configuration file
+# {"targets": {"site-a": {"url": "https://sz-a.example.com:8443", "user": "...", "password": "...", "insecure": true, "wlan_details": ["SSID1"],
+#              "drift_baseline": "Golden"}}}
+# user and password default to API_USER and API_PASSWORD, insecure to the --insecure option
+def load_targets(path):
+    with open(path) as f:
+        config = json.load(f)
+    return config.get('targets', {})
 
 
 # Function to parse command line arguments and pass them to the collector
@@ -343,7 +2443,12 @@ def parse_args():
     # By default argparse will treat any arguments with flags (- or --) as optional
     # Rather than make these required (considered bad form), we can create another group for required options
     required_named = parser.add_argument_group('required named arguments')
-    required_named.add_argument('-t', '--target', help='Target URL and port to access SmartZone, e.g. https://smartzone.example.com:8443', required=True)
+    required_named.add_argument('-t', '--target', help='Target URL and port to access SmartZone, e.g. https://smartzone.example.com:8443')
+
+    # JSON file with the controllers served on /probe?target=<name>
+    parser.add_argument('--config', help='JSON file with the SmartZone targets served on /probe')
+    # Workers shared by the requests of every target
+    parser.add_argument('--workers', type=int, default=32, help='Size of the worker pool shared by all targets (default=32)')
 
     # Add store_false action to store true/false values, and set a default of True
     parser.add_argument('--insecure', action='store_false', help='Allow insecure SSL connections to Smartzone')
@@ -351,28 +2456,337 @@ def parse_args():
     # Specify integer type for the listening port
     parser.add_argument('--port', type=int, default=9345, help='Port on which to expose metrics and web interface (default=9345)')
 
+    # Records per query page and number of pages fetched at the same time
+    parser.add_argument('--page-size', type=int, default=1000, help='Number of records requested per query page (default=1000)')
+    parser.add_argument('--page-workers', type=int, default=4, help='Number of query pages fetched concurrently, split evenly between the targets (default=4)')
+
+    # Parse query/ap responses while they are downloaded
+    parser.add_argument('--stream', action='store_true', help='Parse large query responses incrementally to reduce memory usage')
+
+    # Zone-filtered AP and WLAN queries, balanced with the zone inventory
+    parser.add_argument('--shard-zones', action='store_true', help='Split query/ap and query/wlan into zone-filtered requests run in parallel')
+
+    # Concurrent crawl requests and per-request timeout
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum number of API requests in flight to one target, query pages and drift comparisons included (default=8)')
+    parser.add_argument('--request-timeout', type=float, default=30, help='Timeout in seconds for each API request (default=30)')
+
+    # Retries of failed requests and suspension of failing endpoints
+    parser.add_argument('--retries', type=int, default=2, help='Retries of an API request after a connection error, timeout or server error (default=2)')
+    parser.add_argument('--retry-backoff', type=float, default=0.5, help='Seconds before the first retry, doubled on each retry (default=0.5)')
+    parser.add_argument('--breaker-threshold', type=int, default=5, help='Consecutive failed requests that suspend an API endpoint, 0 to disable (default=5)')
+    parser.add_argument('--breaker-reset', type=float, default=60, help='Seconds an API endpoint stays suspended before it is tried again (default=60)')
+
+    # Cache for the slow-changing WLAN details and schedules
+    parser.add_argument('--wlan-cache-ttl', type=float, default=3600, help='Seconds WLAN details are cached, 0 to disable (default=3600)')
+    parser.add_argument('--scheduler-cache-ttl', type=float, default=3600, help='Seconds WLAN schedules are cached, 0 to disable (default=3600)')
+    parser.add_argument('--cache-size', type=int, default=1024, help='Maximum number of entries kept in each cache (default=1024)')
+
+    # Per-group refresh intervals, e.g. --refresh-interval controller=600 --refresh-interval ap=30
+    parser.add_argument('--refresh-interval', action='append', default=[], metavar='GROUP=SECONDS',
+                        help='Refresh interval of a metric group ({}), repeat for each group (default=0, refresh on every crawl)'.format(', '.join(metric_groups)))
+
+    # Persistent connection pool and service ticket reuse
+    parser.add_argument('--pool-size', type=int, default=16, help='Maximum number of keep-alive connections to the controller (default=16)')
+    parser.add_argument('--ticket-ttl', type=float, default=1800, help='Seconds a service ticket is reused before logging in again (default=1800)')
+
+    # Seconds between background polls; 0 keeps the crawl inside every scrape
+    parser.add_argument('--poll-interval', type=float, default=0, help='Poll the controller in the background every N seconds and serve the latest snapshot (default=0, poll on every scrape)')
+
+    # Render the exposition once per snapshot instead of on every scrape
+    parser.add_argument('--exposition-cache', action='store_true', help='Serve a pre-rendered exposition of each snapshot, requires --poll-interval')
+
+    # Cardinality of the AP metrics, e.g. --ap-labels mac,name --ap-labels numClients5G=zone,mac --ap-info --ap-status enum
+    parser.add_argument('--ap-labels', action='append', default=[], metavar='[FAMILY=]LABEL,...',
+                        help='Labels of the AP metrics ({}), for one family ({}) or all of them; mac is required, none or an empty list (FAMILY=) leaves the family out; repeat for each family'.format(
+                            ', '.join(ap_label_names), ', '.join(ap_families)))
+    parser.add_argument('--ap-info', action='store_true', help='Export the AP model and GPS position once per AP in smartzone_ap_info, instead of smartzone_ap_model')
+    parser.add_argument('--ap-status', choices=['labels', 'enum'], default='labels',
+                        help='Export the AP status as one series per state (labels) or one series per AP holding the state index (enum) (default=labels)')
+
+    # Zones and AP groups to export, as shell-style patterns
+    parser.add_argument('--include-zone', action='append', default=[], metavar='PATTERN', help='Only export zones matching the pattern, repeat for more patterns')
+    parser.add_argument('--exclude-zone', action='append', default=[], metavar='PATTERN', help='Do not export zones matching the pattern')
+    parser.add_argument('--include-ap-group', action='append', default=[], metavar='PATTERN', help='Only export APs of AP groups matching the pattern')
+    parser.add_argument('--exclude-ap-group', action='append', default=[], metavar='PATTERN', help='Do not export APs of AP groups matching the pattern')
+
+    # Distributions of client statistics, aggregated from query/client
+    parser.add_argument('--client-stats', action='store_true', help='Export RSSI, SNR and throughput distributions of the clients, in the client metric group')
+    parser.add_argument('--client-labels', default=','.join(client_label_names), metavar='LABEL,...',
+                        help='Labels of the client distributions, some of {} (default=all)'.format(','.join(client_label_names)))
+    parser.add_argument('--client-quantiles', default='0.1,0.5,0.9', metavar='Q,...', help='Quantiles estimated for each client distribution, empty for none (default=0.1,0.5,0.9)')
+
+    # Compare the zone and WLAN configurations with a baseline zone in the background
+    parser.add_argument('--drift-baseline', metavar='ZONE', help='Export smartzone_config_drift against this baseline zone, drift_baseline in --config targets')
+    parser.add_argument('--drift-interval', type=float, default=3600, help='Seconds between configuration comparisons (default=3600)')
+    parser.add_argument('--drift-max-age', type=float, default=86400, help='Seconds an unchanged configuration is reused before it is fetched again (default=86400)')
+    parser.add_argument('--drift-ssid', action='append', default=[], metavar='SSID', help='Only compare the WLANs of this SSID, repeat for more SSIDs')
+    parser.add_argument('--drift-ignore', action='append', default=[], metavar='PATTERN', help='Configuration path left out of the comparison, e.g. *.description')
+
+    # Keep the last metrics and configurations on disk for a warm start
+    parser.add_argument('--state-dir', help='Directory of the state files, one per target, restored at startup and saved after crawls')
+    parser.add_argument('--state-interval', type=float, default=300, help='Minimum seconds between two saves of the state of a target (default=300)')
+
+    # Push mode, each poll is sent to a remote write receiver or a Pushgateway
+    parser.add_argument('--push-url', metavar='URL', help='Remote write endpoint the polls are pushed to, e.g. http://prometheus:9090/api/v1/write, requires --poll-interval')
+    parser.add_argument('--pushgateway', metavar='URL', help='Pushgateway the polls are pushed to, e.g. http://pushgateway:9091, requires --poll-interval')
+    parser.add_argument('--push-job', default='smartzone', help='job label of the pushed series (default=smartzone)')
+    parser.add_argument('--push-label', action='append', default=[], metavar='NAME=VALUE', help='Label added to every pushed series, repeat for more labels')
+    parser.add_argument('--push-batch-size', type=int, default=2000, help='Series per remote write request (default=2000)')
+    parser.add_argument('--push-queue-size', type=int, default=200, help='Remote write requests kept while the receiver is unreachable, the oldest are dropped beyond (default=200)')
+    parser.add_argument('--push-resend-interval', type=float, default=120, help='Seconds before an unchanged series is pushed again, below the 5 minutes staleness of Prometheus (default=120)')
+    parser.add_argument('--push-retries', type=int, default=5, help='Retries of a push after a connection error, timeout, throttling or server error (default=5)')
+    parser.add_argument('--push-backoff', type=float, default=1, help='Seconds before the first push retry, doubled on each retry up to {} (default=1)'.format(push_max_backoff))
+    parser.add_argument('--push-timeout', type=float, default=30, help='Timeout in seconds of each push request (default=30)')
+    parser.add_argument('--push-insecure', action='store_true', help='Do not verify the certificate of the push receiver')
+
+    # Answer from a fixture recorded with getdata.py --record instead of the controller
+    parser.add_argument('--replay', help='Serve the target from a fixture file recorded with getdata.py --record')
+    parser.add_argument('--replay-latency', type=float, default=0, help='Scale of the recorded response times when replaying, 0 to answer at once (default=0)')
+
     # Now that we've added the arguments, parse them and return the values as output
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    # Turn the GROUP=SECONDS pairs into a dictionary
+    refresh_intervals = {}
+    for item in args.refresh_interval:
+        group, _, seconds = item.partition('=')
+        if group not in metric_groups:
+            parser.error('unknown metric group {}, expected one of {}'.format(group, ', '.join(metric_groups)))
+        try:
+            refresh_intervals[group] = float(seconds)
+        except ValueError:
+            parser.error('invalid refresh interval {}'.format(item))
+    args.refresh_interval = refresh_intervals
+
+    # Turn the [FAMILY=]LABEL,... values into the labels of each family, in exposition order
+    ap_labels = {}
+    for item in args.ap_labels:
+        family, _, names = item.rpartition('=')
+        names = names.split(',')
+        if family and family not in ap_families:
+            parser.error('unknown AP family {}, expected one of {}'.format(family, ', '.join(ap_families)))
+        names = [n for n in names if n]
+        # none, like an empty list, is no label at all
+        if names == ['none']:
+            names = []
+        unknown = [n for n in names if n not in ap_label_names]
+        if unknown:
+            parser.error('unknown AP label {}, expected some of {}'.format(', '.join(unknown), ', '.join(ap_label_names)))
+        # No label at all leaves the family out
+        if names and 'mac' not in names:
+            parser.error('AP labels {} must include mac'.format(item))
+        names = tuple(n for n in ap_label_names if n in names)
+        for f in [family] if family else ap_families:
+            ap_labels[f] = names
+    args.ap_labels = ap_labels
+
+    # Client distribution labels and quantiles
+    args.client_labels = [n for n in args.client_labels.split(',') if n]
+    unknown = [n for n in args.client_labels if n not in client_label_names]
+    if unknown:
+        parser.error('unknown client label {}, expected some of {}'.format(', '.join(unknown), ', '.join(client_label_names)))
+    try:
+        args.client_quantiles = [float(q) for q in args.client_quantiles.split(',') if q]
+    except ValueError:
+        parser.error('invalid client quantiles {}'.format(args.client_quantiles))
+    if any(not 0 <= q <= 1 for q in args.client_quantiles):
+        parser.error('client quantiles must be between 0 and 1')
+
+    if args.state_dir:
+        os.makedirs(args.state_dir, exist_ok=True)
+
+    # At least one controller is needed, either with --target or in the configuration file
+    if not args.target and not args.config and not args.replay:
+        parser.error('the following arguments are required: -t/--target or --config')
+    if args.replay and args.config:
+        parser.error('--replay serves a single target and cannot be used with --config')
+    if args.exposition_cache and args.poll_interval <= 0:
+        parser.error('--exposition-cache requires --poll-interval')
+
+    # Turn the NAME=VALUE pairs into the labels of the pushed series
+    push_labels = []
+    for item in args.push_label:
+        name, _, value = item.partition('=')
+        if not name.isidentifier() or not name.isascii() or name.startswith('__'):
+            parser.error('invalid push label {}'.format(item))
+        push_labels.append((name, value))
+    args.push_label = push_labels
+    if args.push_url and args.pushgateway:
+        parser.error('--push-url and --pushgateway cannot be used together')
+    if (args.push_url or args.pushgateway) and args.poll_interval <= 0:
+        parser.error('pushing requires --poll-interval')
+    return args
+
+# State writers of every target, flushed on exit
+state_writers = []
+
+# Seconds the exit may take, within the 10 seconds docker stop waits before SIGKILL
+# The state saves get what is left of it minus logout_timeout, the logouts of every target run together
+shutdown_timeout = 8
+logout_timeout = 3
 
 def terminate(signal,frame):
-    print("Exiting...")
-    sys.exit(0)
+    stopping.set()
 
 def main():
     signal.signal(signal.SIGTERM, terminate)
 
     args = parse_args()
     port = int(args.port)
-    user = os.environ['API_USER']
-    password = os.environ['API_PASSWORD']
-    REGISTRY.register(SmartZoneCollector(args.target, user, password, args.insecure))
+
+    configured = load_targets(args.config) if args.config else {}
+    count = len(configured) + (1 if args.target or args.replay else 0)
+
+    # Requests of every target run on the same bounded pool
+    pool = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='smartzone-fetch')
+    # Query pages and drift configurations of every target run on another shared pool
+    # Each target gets its share of the page workers, at least one, so the pool grows with the targets if needed
+    page_slots = max(1, args.page_workers // max(1, count))
+    page_pool = ThreadPoolExecutor(max_workers=max(args.page_workers, page_slots * count), thread_name_prefix='smartzone-page')
+
+    # Options shared by every target
+    options = {
+        'page_size': args.page_size,
+        'page_workers': args.page_workers,
+        'pool_size': args.pool_size,
+        'ticket_ttl': args.ticket_ttl,
+        'concurrency': args.concurrency,
+        'timeout': args.request_timeout,
+        'wlan_cache_ttl': args.wlan_cache_ttl,
+        'scheduler_cache_ttl': args.scheduler_cache_ttl,
+        'cache_size': args.cache_size,
+        'refresh_intervals': args.refresh_interval,
+        'pool': pool,
+        'page_pool': page_pool,
+        'page_slots': page_slots,
+        'stream': args.stream,
+        'shard_zones': args.shard_zones,
+        'retries': args.retries,
+        'backoff': args.retry_backoff,
+        'breaker_threshold': args.breaker_threshold,
+        'breaker_reset': args.breaker_reset,
+        'ap_labels': args.ap_labels,
+        'ap_info': args.ap_info,
+        'ap_status': args.ap_status,
+        'include_zones': args.include_zone,
+        'exclude_zones': args.exclude_zone,
+        'include_ap_groups': args.include_ap_group,
+        'exclude_ap_groups': args.exclude_ap_group,
+        'drift_interval': args.drift_interval,
+        'drift_max_age': args.drift_max_age,
+        'drift_ssids': args.drift_ssid,
+        'drift_ignore': args.drift_ignore,
+        'client_stats': args.client_stats,
+        'client_labels': args.client_labels,
+        'client_quantiles': args.client_quantiles,
+    }
+
+    push_options = {
+        'retries': args.push_retries,
+        'backoff': args.push_backoff,
+        'timeout': args.push_timeout,
+        'verify': not args.push_insecure,
+    }
+
+    def make_target(name, url, user, password, insecure, wlan_details=None, transport=None, drift_baseline=None):
+        collector = SmartZoneCollector(url, user, password, insecure, wlan_details=wlan_details, transport=transport,
+                                       drift_baseline=drift_baseline or args.drift_baseline, name=name, **options)
+        if args.state_dir:
+            path = state_path(args.state_dir, name)
+            state = load_state(path, collector._target)
+            if state is not None:
+                collector.restore(state)
+                print('Restored state of {} saved {:.0f} seconds ago'.format(url, time.time() - state['saved']))
+            writer = StateWriter(collector, path, args.state_interval)
+            collector.listeners.append(writer)
+            state_writers.append(writer)
+        if collector._drift is not None:
+            collector._drift.start()
+        if args.poll_interval <= 0:
+            return collector
+        poller = SmartZonePoller(collector, args.poll_interval, live_age=not args.exposition_cache)
+        # The series of each target are told apart by their instance label, the target name
+        grouping = [('job', args.push_job), ('instance', name)] + args.push_label
+        writer = None
+        if args.push_url:
+            writer = RemoteWriter(poller, args.push_url, grouping, batch_size=args.push_batch_size, queue_size=args.push_queue_size,
+                                  resend=args.push_resend_interval, **push_options)
+        elif args.pushgateway:
+            writer = PushgatewayWriter(poller, args.pushgateway, grouping, **push_options)
+        if writer is not None:
+            poller.listeners.append(writer)
+            writer.start()
+        return poller
+
+    targets = OrderedDict()
+    caches = {}
+    if args.replay:
+        # The credentials are not part of the fixture, any value is accepted
+        fixture = load_fixture(args.replay)
+        args.target = args.target or fixture['target']
+        targets[args.target] = make_target(args.target, args.target, os.environ.get('API_USER', ''), os.environ.get('API_PASSWORD', ''), args.insecure,
+                                           transport=ReplayAdapter(fixture, args.replay_latency))
+    elif args.target:
+        targets[args.target] = make_target(args.target, args.target, os.environ['API_USER'], os.environ['API_PASSWORD'], args.insecure)
+    if args.target:
+        # The --target controller is served on /metrics, as well as on /probe
+        REGISTRY.register(targets[args.target])
+        if args.exposition_cache:
+            caches['/metrics'] = ExpositionCache(REGISTRY)
+            targets[args.target].listeners.append(caches['/metrics'].refresh)
+    if args.config:
+        for name, t in configured.items():
+            # In the file insecure: true disables certificate verification, like the --insecure option
+            insecure = not t['insecure'] if 'insecure' in t else args.insecure
+            targets[name] = make_target(name, t['url'], t.get('user', os.environ.get('API_USER')), t.get('password', os.environ.get('API_PASSWORD')),
+                                        insecure, t.get('wlan_details'), drift_baseline=t.get('drift_baseline'))
+            if args.exposition_cache:
+                registry = CollectorRegistry(auto_describe=False)
+                registry.register(targets[name])
+                registry.register(ProbeStatusCollector(targets[name]))
+                caches[name] = ExpositionCache(registry)
+                targets[name].listeners.append(caches[name].refresh)
+
+    # Pollers start once their exposition caches are in place
+    for t in targets.values():
+        if isinstance(t, SmartZonePoller):
+            t.start()
+
     # Start HTTP server on specified port
-    start_http_server(port)
+    httpd = make_server('', port, make_exporter_app(targets, caches), ThreadingWSGIServer, handler_class=QuietHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
     if args.insecure == False:
-            print('WARNING: Connection to {} may not be secure.'.format(args.target))
-    print("Polling {}. Listening on ::{}".format(args.target, port))
-    while True:
-        time.sleep(1)
+            print('WARNING: Connection to {} may not be secure.'.format(', '.join(targets)))
+    print("Polling {}. Listening on ::{}".format(', '.join(targets), port))
+    while not stopping.wait(1):
+        pass
+
+    print("Exiting...")
+    deadline = time.time() + shutdown_timeout
+    # No new poll or comparison starts from here on
+    collectors = [t._collector if isinstance(t, SmartZonePoller) else t for t in targets.values()]
+    for t in targets.values():
+        if isinstance(t, SmartZonePoller):
+            t.stop()
+    for collector in collectors:
+        if collector._drift is not None:
+            collector._drift.stop()
+    # A crawl still running holds the state of its target, the last save is kept rather than waiting for it
+    for writer in state_writers:
+        writer.save(timeout=max(0, deadline - logout_timeout - time.time()))
+    # Queued requests are dropped, the ones in flight are cut short by the exit
+    pool.shutdown(wait=False, cancel_futures=True)
+    page_pool.shutdown(wait=False, cancel_futures=True)
+    # Release the service tickets instead of leaving them to expire on the controller
+    # Every session is closed, so requests still in flight cannot log in again
+    logouts = [threading.Thread(target=c._session.logout, args=(logout_timeout,), daemon=True) for c in collectors]
+    for t in logouts:
+        t.start()
+    for t in logouts:
+        t.join(max(0, deadline - time.time()))
+    sys.stdout.flush()
+    # Exiting the interpreter would join the pool workers, which may wait for the controller until their timeout
+    os._exit(0)
 
 if __name__ == "__main__":
     main()